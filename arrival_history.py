@@ -0,0 +1,267 @@
+#! /usr/bin/env python3
+"""
+Historique des arrivées annoncées et statistiques de retard.
+
+Chaque heure d'arrivée annoncée par le service est ajoutée à un fichier
+circulaire de taille fixe, projeté en mémoire (mmap) : une fois plein,
+les enregistrements les plus anciens sont remplacés. L'écriture ne coûte
+qu'une copie en mémoire, le système reportant l'écriture sur disque, et
+seules les annonces nouvelles ou modifiées sont ajoutées.
+
+    ./main.py --history tram.hist --station 275A token
+    ./arrival_history.py tram.hist --since 168 --line A
+
+Les statistiques sont calculées en parcourant le fichier sans le charger :
+retard par ligne (dernière heure annoncée d'une course moins son heure
+théorique, si le service la fournit) et erreur des annonces selon leur
+échéance (dernière heure annoncée moins l'heure annoncée alors).
+"""
+
+from array import array
+from datetime import datetime
+import argparse
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+
+HISTORY_RECORDS = 200000    # Nb d'enregistrements du fichier (16 Mo)
+FORGET_AFTER = 3600         # Annonces passées oubliées après une heure
+MAGIC = b'TRAMHIS1'
+
+# Magie, taille d'un enregistrement, capacité, nb total d'enregistrements
+# écrits ; complété à 64 octets.
+HEADER = struct.Struct('<8sII Q 40x')
+# Observation, heure annoncée, heure théorique (NaN si inconnue) en
+# secondes epoch, station, ligne, destination, course.
+RECORD = struct.Struct('<ddd 8s 4s 24s 20s')
+# Échéances des annonces (minutes) pour l'erreur de prévision.
+HORIZONS = (2, 5, 10, 20, 40)
+
+logger = logging.getLogger(__name__)
+
+
+def encode(text, size, tail=False):
+    """Chaîne tronquée à size octets, en gardant la fin si tail (numéros
+    de course)."""
+    data = (text or '').encode()
+    return data[-size:] if tail else data[:size]
+
+
+def decode(field):
+    return field.rstrip(b'\0').decode(errors='ignore')
+
+
+class ArrivalHistory:
+    """Fichier circulaire des annonces d'arrivée.
+
+    La capacité est fixée à la création du fichier, celle d'un fichier
+    existant est conservée. Le nb d'enregistrements écrits n'est mis à
+    jour qu'après eux.
+
+    Attributs:
+        path: fichier d'historique
+        capacity: nb d'enregistrements du fichier
+        count: nb total d'enregistrements écrits depuis sa création
+        map: mmap du fichier
+        last: dict, dernière heure annoncée (secondes epoch) par course
+    """
+
+    def __init__(self, path, capacity=HISTORY_RECORDS, readonly=False):
+        self.path = path
+        self.last = {}
+        flags = os.O_RDONLY if readonly else os.O_RDWR | os.O_CREAT
+        fd = os.open(path, flags, 0o644)
+        try:
+            if os.fstat(fd).st_size < HEADER.size:
+                if readonly:
+                    raise ValueError('{}: empty history.'.format(path))
+                # Fichier creux : les blocs ne sont alloués qu'à l'écriture.
+                os.ftruncate(fd, HEADER.size + capacity * RECORD.size)
+                os.pwrite(fd, HEADER.pack(MAGIC, RECORD.size, capacity, 0), 0)
+            self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ if readonly
+                    else mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+
+        magic, size, self.capacity, self.count = HEADER.unpack_from(self.map)
+        if magic != MAGIC or size != RECORD.size or len(self.map) < \
+                HEADER.size + self.capacity * size:
+            self.map.close()
+            raise ValueError('{}: not a history file.'.format(path))
+        if not readonly and self.capacity != capacity:
+            logger.info('History %s keeps its capacity of %d records.',
+                    path, self.capacity)
+
+    def close(self):
+        self.map.close()
+
+    def append(self, records):
+        """Ajoute des enregistrements déjà mis au format RECORD."""
+        for record in records:
+            offset = HEADER.size + self.count % self.capacity * RECORD.size
+            self.map[offset:offset + RECORD.size] = record
+            self.count += 1
+        HEADER.pack_into(self.map, 0, MAGIC, RECORD.size, self.capacity,
+                self.count)
+
+    def record(self, visits, observed=None):
+        """Ajoute les annonces nouvelles ou modifiées.
+
+        visits: dict, TramArriv par référence de station
+        observed: date de l'observation (time.time), maintenant par défaut
+        """
+        observed = observed or time.time()
+        records = []
+        for ref, arrivals in visits.items():
+            for tram in arrivals:
+                expected = tram.expected_arriv.timestamp()
+                aimed = tram.aimed_arriv.timestamp() if tram.aimed_arriv \
+                        else math.nan
+                # Sans référence de course, chaque heure annoncée est une
+                # nouvelle course.
+                key = (ref, tram.journey or (tram.line_ref, tram.destination,
+                    tram.aimed_arriv or expected))
+                if self.last.get(key) == expected:
+                    continue
+                self.last[key] = expected
+                records.append(RECORD.pack(observed, expected, aimed,
+                    encode(ref, 8), encode(tram.line_ref, 4),
+                    encode(tram.destination, 24),
+                    encode(tram.journey, 20, tail=True)))
+        if records:
+            self.append(records)
+        self.last = {key: expected for key, expected in self.last.items()
+                if expected > observed - FORGET_AFTER}
+
+    def records(self):
+        """Tuples RECORD du plus ancien au plus récent, lus sans copie du
+        fichier."""
+        stored = min(self.count, self.capacity)
+        start = self.count % self.capacity if self.count > self.capacity \
+                else 0
+        view = memoryview(self.map)
+        try:
+            for first, last in ((start, stored), (0, start)):
+                yield from RECORD.iter_unpack(view[HEADER.size
+                    + first * RECORD.size:HEADER.size + last * RECORD.size])
+        finally:
+            view.release()
+
+
+def percentile(values, fraction):
+    """Valeur au rang fraction de values triées."""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def journey_key(record):
+    _, expected, aimed, station, line, destination, journey = record
+    if journey.strip(b'\0'):
+        return station, journey
+    return station, line, destination, aimed if aimed == aimed else expected
+
+
+def statistics(history, since=0.0, station=None, line=None):
+    """Retards par ligne et erreurs des annonces par échéance.
+
+    Arguments:
+        since: date (time.time) des premières observations retenues
+        station, line: références retenues, toutes par défaut
+    Renvoie deux dict d'array de minutes : retards par ligne, erreurs par
+    indice d'échéance dans HORIZONS (len(HORIZONS) au-delà), puis le nb
+    d'enregistrements retenus et la date de la première de leurs
+    observations (None sans enregistrement).
+    """
+    station = station and encode(station, 8).ljust(8, b'\0')
+    line = line and encode(line, 4).ljust(4, b'\0')
+
+    def selected():
+        for record in history.records():
+            if record[0] >= since and (station is None
+                    or record[3] == station) and (line is None
+                    or record[4] == line):
+                yield record
+
+    # Premier passage : dernière annonce de chaque course, qui tient lieu
+    # d'heure d'arrivée réelle.
+    final = {}
+    count = 0
+    first = None
+    for record in selected():
+        final[journey_key(record)] = record
+        count += 1
+        if first is None:
+            first = record[0]
+
+    delays = {}
+    for _, expected, aimed, _, line_ref, _, _ in final.values():
+        if aimed == aimed:
+            delays.setdefault(decode(line_ref), array('d')).append(
+                    (expected - aimed) / 60)
+
+    errors = {}
+    for record in selected():
+        observed, expected = record[:2]
+        horizon = (expected - observed) / 60
+        # Course remplacée entre les deux passages (fichier en écriture).
+        last = final.get(journey_key(record))
+        if horizon < 0 or last is None:
+            continue
+        index = sum(horizon >= bound for bound in HORIZONS)
+        errors.setdefault(index, array('d')).append(
+                (last[1] - expected) / 60)
+    return delays, errors, count, first
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Delay and prediction statistics from a history '
+                'written by main.py --history.')
+    parser.add_argument('history', help='history file')
+    parser.add_argument('--since', type=float, metavar='HOURS',
+            help='only the last HOURS hours')
+    parser.add_argument('--station', help='only this station reference')
+    parser.add_argument('--line', help='only this line')
+    args = parser.parse_args()
+
+    history = ArrivalHistory(args.history, readonly=True)
+    since = time.time() - args.since * 3600 if args.since else 0.0
+    delays, errors, count, first = statistics(history, since, args.station,
+            args.line)
+    stored = min(history.count, history.capacity)
+    if count:
+        print('{} of {} records since {:%Y-%m-%d %H:%M}.'.format(count,
+            stored, datetime.fromtimestamp(first)))
+    else:
+        print('No record selected of {}.'.format(stored))
+
+    print('\nDelay of the last prediction to the timetable (minutes)')
+    print('{:6} {:>6} {:>6} {:>6} {:>6} {:>6}'.format('line', 'trips',
+        'mean', 'median', 'p90', 'max'))
+    for name, values in sorted(delays.items()):
+        values = sorted(values)
+        print('{:6} {:6} {:6.1f} {:6.1f} {:6.1f} {:6.1f}'.format(name,
+            len(values), sum(values) / len(values), percentile(values, 0.5),
+            percentile(values, 0.9), values[-1]))
+    if not delays:
+        print('no timetable time recorded')
+
+    print('\nPrediction error by horizon (minutes, last prediction minus '
+            'prediction)')
+    print('{:8} {:>7} {:>6} {:>8} {:>8}'.format('horizon', 'count', 'mean',
+        'mean abs', 'p90 abs'))
+    bounds = (0,) + HORIZONS
+    for index, values in sorted(errors.items()):
+        name = '{}-{}'.format(bounds[index], HORIZONS[index]) \
+                if index < len(HORIZONS) else '{}+'.format(bounds[index])
+        spread = sorted(abs(value) for value in values)
+        print('{:8} {:7} {:6.1f} {:8.1f} {:8.1f}'.format(name, len(values),
+            sum(values) / len(values), sum(spread) / len(spread),
+            percentile(spread, 0.9)))
+    history.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Estimation locale des arrivées au-delà des dernières annonces.
+
+L'intervalle entre deux trams de même ligne et de même destination est
+appris des réponses récentes : écart entre les courses successives vues
+à une station, et entre les passages d'une même réponse. Les dernières
+arrivées annoncées sont complétées de passages estimés à cet intervalle
+quand elles ont expiré ou que la réponse a été tronquée, ce qui garde
+l'écran utile quand le service ne répond plus ou que le quota de
+requêtes est épuisé, et permet d'espacer les requêtes.
+
+Les arrivées estimées (TramArriv.estimated) s'affichent marquées d'un ~.
+"""
+
+from collections import deque
+from datetime import timedelta
+import statistics
+import threading
+
+LEARN_WINDOW = timedelta(hours=2)       # Courses retenues pour l'intervalle
+MIN_HEADWAY = timedelta(minutes=2)      # Écarts plus courts ignorés
+MAX_HEADWAY = timedelta(minutes=30)     # Au-delà, pas d'estimation
+ESTIMATE_LIMIT = timedelta(hours=1)     # Estimations après la dernière annonce
+HORIZON = timedelta(minutes=90)         # Estimations à venir au plus
+GAPS_KEPT = 20                          # Écarts conservés par ligne
+
+
+class HeadwayModel:
+    """Intervalles entre trams par station, ligne et destination.
+
+    Attributs:
+        trips: dict, heure annoncée par référence de course, par clé
+            (station, ligne, destination)
+        gaps: dict, derniers écarts (timedelta) entre passages sans
+            référence de course d'une même réponse, par clé
+    """
+
+    def __init__(self):
+        self.trips = {}
+        self.gaps = {}
+        self._lock = threading.Lock()
+
+    def learn(self, visits, now):
+        """Retient les courses et écarts des arrivées annoncées.
+
+        visits: dict, TramArriv par référence de station
+        now: datetime locale naïve de la réponse
+        """
+        with self._lock:
+            for ref, arrivals in visits.items():
+                last = {}
+                for tram in sorted(arrivals,
+                        key=lambda tram: tram.expected_arriv):
+                    key = (ref, tram.line_ref, tram.destination)
+                    if tram.journey is not None:
+                        self.trips.setdefault(key, {})[tram.journey] = \
+                                tram.expected_arriv
+                        continue
+                    # Sans référence de course, écarts au sein de la réponse.
+                    if key in last:
+                        gap = tram.expected_arriv - last[key]
+                        if MIN_HEADWAY <= gap <= MAX_HEADWAY:
+                            self.gaps.setdefault(key,
+                                    deque(maxlen=GAPS_KEPT)).append(gap)
+                    last[key] = tram.expected_arriv
+
+            for key, trips in list(self.trips.items()):
+                for journey, expected in list(trips.items()):
+                    if expected < now - LEARN_WINDOW:
+                        del trips[journey]
+                if not trips:
+                    del self.trips[key]
+
+    def headway(self, key):
+        """Intervalle médian pour une clé, None s'il est inconnu."""
+        with self._lock:
+            times = sorted(self.trips.get(key, {}).values())
+            gaps = [later - earlier for earlier, later
+                    in zip(times, times[1:])
+                    if MIN_HEADWAY <= later - earlier <= MAX_HEADWAY]
+            gaps += self.gaps.get(key, ())
+        if not gaps:
+            return None
+        return statistics.median_low(gaps)
+
+    def extend(self, ref, arrivals, now, stale=False):
+        """Arrivées annoncées à une station suivies des arrivées estimées.
+
+        Les arrivées estimées suivent la dernière annonce de chaque ligne
+        et destination, de l'intervalle appris, jusqu'à ESTIMATE_LIMIT
+        après elle et HORIZON après now.
+
+        stale: les annonces ont expiré et sont elles-mêmes des estimations
+        """
+        result = [tram._replace(estimated=True) if stale else tram
+                for tram in arrivals]
+        latest = {}
+        for tram in arrivals:
+            key = (ref, tram.line_ref, tram.destination)
+            if key not in latest or tram.expected_arriv > \
+                    latest[key].expected_arriv:
+                latest[key] = tram
+
+        for key, tram in latest.items():
+            headway = self.headway(key)
+            if headway is None:
+                continue
+            last = tram.expected_arriv
+            expected = last + headway
+            while expected <= min(last + ESTIMATE_LIMIT, now + HORIZON):
+                if expected > now:
+                    result.append(tram._replace(expected_arriv=expected,
+                        journey=None, aimed_arriv=None, estimated=True))
+                expected += headway
+        return result
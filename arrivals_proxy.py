@@ -0,0 +1,254 @@
+"""
+Partage des arrivées entre plusieurs écrans.
+
+Un seul processus interroge l'API de la CTS et sert les arrivées lues
+aux autres écrans sur le réseau local, le trafic vers l'API restant le
+même quel que soit leur nombre :
+
+    ./main.py --serve 0.0.0.0:8081 --station 275A --station 298B token
+    ./main.py --proxy http://192.168.1.10:8081/ --station 275A
+
+La réponse servie pour un ensemble de stations est conservée jusqu'à
+la publication de nouvelles arrivées ou leur fin de validité, et les
+écrans l'interrogent par requêtes conditionnelles (ETag).
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urljoin
+import json
+import logging
+import threading
+
+import requests
+import shared_data
+import siri_parser
+from poll_scheduler import PollScheduler, RequestBudget
+
+PROXY_DELAY = 5             # Délai minimum entre deux interrogations du proxy
+PROXY_MAX_DELAY = 60        # Délai maximum, même si les données sont valides
+PROXY_PER_HOUR = 3600       # Quota de requêtes vers le proxy
+CONNECT_TIMEOUT = 2
+READ_TIMEOUT = 5
+MAX_RESPONSES = 32          # Réponses conservées, les plus anciennes oubliées
+
+logger = logging.getLogger(__name__)
+
+
+def encode_arrival(tram):
+    """TramArriv en liste JSON, les heures avec leur décalage UTC."""
+    return [tram.line_ref, tram.expected_arriv.astimezone().isoformat(),
+            tram.destination, tram.station, tram.journey,
+            tram.aimed_arriv and tram.aimed_arriv.astimezone().isoformat(),
+            tram.estimated]
+
+
+def decode_arrival(values):
+    """TramArriv d'une liste JSON, les heures ramenées en heure locale.
+
+    La course, l'heure théorique et l'estimation manquent aux listes des
+    versions précédentes du proxy.
+    """
+    line_ref, expected, destination, station, *extra = values
+    journey, aimed, estimated = (extra + [None, None, False])[:3]
+    return shared_data.TramArriv(line_ref, siri_parser.parse_time(expected),
+            destination, station, journey,
+            aimed and siri_parser.parse_time(aimed), estimated)
+
+
+class ProxyServer(ThreadingHTTPServer):
+    """Serveur des arrivées publiées par un InfosThr.
+
+    GET /arrivals?station=275A&station=298B renvoie :
+        {"valid_until": date ISO ou null,
+         "stations": {réf: {"version": n, "published": date (time.time),
+                            "arrivals": [[ligne, heure, destination,
+                                          station, course, heure
+                                          théorique, estimée], ...]}}}
+
+    Attributs:
+        shared: dict, SnapshotChannel par référence de station
+        infos: InfosThr alimentant les canaux
+        responses: OrderedDict, (ETag, corps) par tuple trié de
+            références, MAX_RESPONSES au plus
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, shared, infos):
+        super().__init__(address, ProxyHandler)
+        self.shared = shared
+        self.infos = infos
+        self.responses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Sert les requêtes dans un thread daemon."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def response(self, refs):
+        """ETag et corps JSON de la réponse pour refs, tuple trié de
+        stations suivies.
+
+        Le corps n'est reconstruit qu'à la publication de nouvelles
+        arrivées ou d'une nouvelle fin de validité.
+        """
+        snapshots = [self.shared[ref].snapshot for ref in refs]
+        valid_until = self.infos.valid_until
+        etag = '"{}"'.format('-'.join([str(snapshot.version)
+            for snapshot in snapshots]
+            + ['{:%H%M%S}'.format(valid_until) if valid_until else '0']))
+        with self._lock:
+            cached = self.responses.get(refs)
+            if cached is not None:
+                self.responses.move_to_end(refs)
+        if cached is not None and cached[0] == etag:
+            return cached
+
+        body = json.dumps({
+            'valid_until': valid_until and valid_until.astimezone()
+                .isoformat(),
+            'stations': {ref: {'version': snapshot.version,
+                               'published': snapshot.published,
+                               'arrivals': [encode_arrival(tram)
+                                   for tram in snapshot.arrivals]}
+                for ref, snapshot in zip(refs, snapshots)}}).encode()
+        with self._lock:
+            self.responses[refs] = (etag, body)
+            self.responses.move_to_end(refs)
+            while len(self.responses) > MAX_RESPONSES:
+                self.responses.popitem(last=False)
+        return etag, body
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        # Une seule réponse par ensemble de stations, quel qu'en soit
+        # l'ordre ou les répétitions.
+        refs = tuple(sorted(set(parse_qs(url.query).get('station', []))))
+        if url.path.rstrip('/') != '/arrivals' or not refs:
+            self.send_error(404)
+            return
+        unknown = [ref for ref in refs if ref not in self.server.shared]
+        if unknown:
+            self.send_error(404, 'Unknown station {}'.format(
+                ','.join(unknown)))
+            return
+
+        etag, body = self.server.response(refs)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ProxyInfosThr(threading.Thread):
+    """Thread de récupération des données auprès d'un ProxyServer, à la
+    place d'InfosThr.
+
+    Attributs:
+        shared: dict, SnapshotChannel des arrivées par référence de station
+        stop_event: objet event pour signaler l'arrêt du script
+        logger: objet de log
+        url: adresse des arrivées sur le proxy
+        params: dict, arguments de la requête GET
+        session: requests.Session, connexion persistante au proxy
+        etag: ETag de la dernière réponse
+        versions: dict, version et date de la dernière publication par
+            station
+        listeners: fonctions appelées après chaque transfert de données
+        scheduler: PollScheduler, délais en cas d'échec
+        valid_until: datetime, fin de validité des données du proxy
+    """
+
+    def __init__(self, shared, stop_event, station_refs, url):
+        threading.Thread.__init__(self)
+        self.shared = shared
+        self.stop_event = stop_event
+        self.logger = logging.getLogger(__name__)
+        self.url = urljoin(url, 'arrivals')
+        self.params = {'station': list(station_refs)}
+        self.session = requests.Session()
+        self.session.headers.update({'Accept': 'application/json'})
+        self.etag = None
+        self.versions = {}
+        self.listeners = []
+        self.scheduler = PollScheduler(RequestBudget(PROXY_PER_HOUR))
+        self.valid_until = None
+
+    def load_cache(self):
+        """Les arrivées sont conservées par le proxy, aucun délai."""
+        return 0
+
+    def close(self):
+        self.session.close()
+
+    def run(self):
+        while True:
+            delay = self.poll()
+            if delay is None or self.stop_event.wait(timeout=delay):
+                break
+
+        self.close()
+
+    def poll(self):
+        """Interroge le proxy et transfère les données.
+
+        Renvoie le délai avant la prochaine interrogation.
+        """
+        headers = {'If-None-Match': self.etag} if self.etag else {}
+        try:
+            self.scheduler.budget.consume()
+            req = self.session.get(self.url, params=self.params,
+                    headers=headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            if req.status_code != requests.codes.not_modified:
+                req.raise_for_status()
+                self.publish(req.json())
+                self.etag = req.headers.get('ETag')
+        # Réponse illisible, ou d'un proxy d'une autre version.
+        except (requests.exceptions.RequestException, ValueError, KeyError,
+                TypeError, AttributeError) as err:
+            delay = self.scheduler.retry_delay()
+            self.logger.exception('Proxy error (%s). Retry in %d seconds.',
+                    err, delay, exc_info=False)
+            return delay
+
+        self.scheduler.failures = 0
+        delay = PROXY_DELAY
+        if self.valid_until is not None:
+            delay = min(max(delay, (self.valid_until - datetime.now())
+                .total_seconds()), PROXY_MAX_DELAY)
+        return max(delay, self.scheduler.budget.delay())
+
+    def publish(self, data):
+        """Publie les arrivées des stations dont la version a changé."""
+        valid_until = data['valid_until']
+        self.valid_until = valid_until and siri_parser.parse_time(valid_until)
+        changed = False
+        for ref, station in data['stations'].items():
+            # Version 0 : rien n'a encore été publié par le proxy.
+            version = (station['version'], station['published'])
+            if not station['version'] or ref not in self.shared \
+                    or self.versions.get(ref) == version:
+                continue
+            arrivals = [decode_arrival(values)
+                    for values in station['arrivals']]
+            self.shared[ref].publish(arrivals, station['published'])
+            self.versions[ref] = version
+            changed = True
+        if changed:
+            for listener in self.listeners:
+                listener()
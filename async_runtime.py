@@ -0,0 +1,106 @@
+"""
+Exécution dans une boucle asyncio.
+
+Alternative aux deux threads : récupération des données, affichage,
+animation et signaux sont des coroutines d'une même boucle. Les
+récupérations préviennent l'affichage dès qu'elles transfèrent des
+données au lieu d'attendre qu'il les relise.
+
+Les requêtes HTTP restant bloquantes, chaque interrogation s'exécute
+dans l'exécuteur par défaut de la boucle.
+"""
+
+import asyncio
+import logging
+import signal
+
+from lcd_display import REFRESH_TIME, ANIM_REFRESH_TIME, STATIC_REFRESH
+
+logger = logging.getLogger(__name__)
+
+
+async def wait_event(event, timeout):
+    """Attend event au plus timeout secondes, renvoie son état."""
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    return event.is_set()
+
+
+async def fetch_loop(infos, stop):
+    """Interrogations successives d'un InfosThr."""
+    await wait_event(stop, infos.load_cache())
+    while not stop.is_set():
+        delay = await asyncio.to_thread(infos.poll)
+        if delay is None:
+            stop.set()
+            break
+        await wait_event(stop, delay)
+
+
+async def render_loop(display, updated, stop):
+    """Affichage d'un DisplayThr, réveillé par les nouvelles données."""
+    while not stop.is_set():
+        updated.clear()
+        try:
+            if display.refresh():
+                await wait_event(updated, display.next_change())
+                continue
+
+            if not display.idle_screen():
+                # Veille jusqu'aux prochaines arrivées.
+                await wait_event(updated, STATIC_REFRESH)
+                continue
+
+            # Nothing to disclose, idle
+            for _ in display.idle_animation:
+                if await wait_event(updated, ANIM_REFRESH_TIME) \
+                        or not display.idle.animate():
+                    break
+            else:
+                await wait_event(updated, REFRESH_TIME)
+
+        except OSError:
+            logger.exception('Connection error. Abort.', exc_info=False)
+            stop.set()
+
+
+async def run(fetchers, displays, stop_event):
+    """Exécute fetchers (InfosThr) et displays (DisplayThr) jusqu'à la
+    réception d'un signal ou l'abandon de l'un d'eux.
+
+    stop_event est l'objet event partagé avec les threads, positionné à
+    l'arrêt.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    updates = [asyncio.Event() for _ in displays]
+
+    def shutdown():
+        stop.set()
+        stop_event.set()
+        for updated in updates:
+            updated.set()
+
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        loop.add_signal_handler(signum, shutdown)
+
+    def notify():
+        for updated in updates:
+            updated.set()
+
+    for infos in fetchers:
+        # poll s'exécute hors de la boucle.
+        infos.listeners.append(lambda: loop.call_soon_threadsafe(notify))
+
+    tasks = ([asyncio.create_task(fetch_loop(infos, stop))
+                for infos in fetchers]
+            + [asyncio.create_task(render_loop(display, updated, stop))
+                for display, updated in zip(displays, updates)])
+    await stop.wait()
+    shutdown()
+    await asyncio.gather(*tasks)
+
+    for infos in fetchers:
+        infos.close()
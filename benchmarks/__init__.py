@@ -0,0 +1,6 @@
+"""
+Mesures de performance, à lancer depuis la racine du dépôt :
+
+    python -m benchmarks.run [--save résultats.json]
+    python -m benchmarks.bench_parser [réponses.json ...]
+"""
@@ -0,0 +1,68 @@
+"""
+Comparaison de siri_parser avec la lecture d'origine d'InfosThr
+(re.sub puis datetime.strptime, chemins du dict parcourus à chaque
+champ).
+
+    python -m benchmarks.bench_parser [réponses.json ...]
+"""
+
+from datetime import datetime
+import re
+import sys
+import timeit
+
+import shared_data
+import siri_parser
+from benchmarks import payloads
+
+
+def legacy_parse(responses, stations):
+    """Lecture telle qu'effectuée avant siri_parser."""
+    valid_until = None
+    visits = {ref: [] for ref in stations}
+    for refs, data in responses:
+        for i, _ in enumerate(data['ServiceDelivery']
+                ['StopMonitoringDelivery']):
+            valid_until_str = re.sub(r"^(.*)(\+|\-).*", r"\1",
+                    (data['ServiceDelivery']['StopMonitoringDelivery'][i]
+                    ['ValidUntil']), flags=re.ASCII)
+            until = datetime.strptime(valid_until_str, '%Y-%m-%dT%H:%M:%S')
+            if valid_until is None or until < valid_until:
+                valid_until = until
+            tram_infos = (data['ServiceDelivery']['StopMonitoringDelivery']
+                    [i].get('MonitoredStopVisit', ()))
+            for val in tram_infos:
+                arrival_str = re.sub(r"^(.*)(\+|\-).*", r"\1",
+                        (val['MonitoredVehicleJourney']['MonitoredCall']
+                            ['ExpectedArrivalTime']), flags=re.ASCII)
+                arrival_time = datetime.strptime(arrival_str,
+                        '%Y-%m-%dT%H:%M:%S')
+                ref = siri_parser.visit_ref(val, refs)
+                visits[ref].append(shared_data.TramArriv(
+                    val['MonitoredVehicleJourney']['LineRef'], arrival_time,
+                    val['MonitoredVehicleJourney']['DestinationShortName'],
+                    val['MonitoredVehicleJourney']['MonitoredCall']
+                        ['StopPointName']))
+    return valid_until, visits
+
+
+def bench(func, responses, stations, number):
+    return min(timeit.repeat(lambda: func(responses, stations),
+        number=number, repeat=5)) / number
+
+
+def main(paths):
+    for refs, data in payloads.load(paths):
+        responses = [(refs, data)]
+        count = sum(len(delivery.get('MonitoredStopVisit', ()))
+                for delivery in data['ServiceDelivery']
+                ['StopMonitoringDelivery'])
+        legacy = bench(legacy_parse, responses, refs, 2000)
+        fast = bench(siri_parser.parse_stop_monitoring, responses, refs, 2000)
+        print('{} station(s), {} visits: legacy {:.1f} us, '
+              'siri_parser {:.1f} us, x{:.1f}'.format(len(refs), count,
+                  legacy * 1e6, fast * 1e6, legacy / fast))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
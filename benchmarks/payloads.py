@@ -0,0 +1,96 @@
+"""
+Réponses stop-monitoring pour les mesures.
+
+Des réponses enregistrées peuvent être passées en fichiers JSON ou en
+enregistrements de siri_replay (.jsonl), à défaut des réponses de même
+forme que celles de l'API CTS sont générées.
+"""
+
+from datetime import datetime, timedelta, timezone
+import json
+
+import siri_replay
+
+LINES = ('A', 'B', 'C', 'D', 'E', 'F')
+DESTINATIONS = ('Hoenheim', 'Illkirch', 'Lingolsheim', 'Kehl', 'Robertsau')
+
+
+def _iso(date):
+    return date.isoformat(timespec='seconds')
+
+
+def synthetic_response(refs, visits=3, now=None):
+    """Réponse comportant visits passages pour chaque référence."""
+    now = now or datetime.now(timezone.utc).astimezone()
+    stop_visits = []
+    for i, ref in enumerate(refs):
+        for j in range(visits):
+            arrival = now + timedelta(minutes=2 + 4 * j + i)
+            stop_visits.append({
+                'RecordedAtTime': _iso(now),
+                'MonitoringRef': ref,
+                'StopCode': ref,
+                'MonitoredVehicleJourney': {
+                    'LineRef': LINES[(i + j) % len(LINES)],
+                    'DirectionRef': j % 2,
+                    'FramedVehicleJourneyRef': {
+                        'DataFrameRef': _iso(now)[:10],
+                        'DatedVehicleJourneyRef': 'SIRI:{}{}'.format(ref, j),
+                    },
+                    'PublishedLineName': LINES[(i + j) % len(LINES)],
+                    'DestinationName': DESTINATIONS[j % len(DESTINATIONS)],
+                    'DestinationShortName':
+                        DESTINATIONS[j % len(DESTINATIONS)],
+                    'VehicleMode': 'tram',
+                    'MonitoredCall': {
+                        'StopPointRef': ref,
+                        'StopPointName': 'Station {}'.format(ref),
+                        'Order': 12,
+                        'ExpectedArrivalTime': _iso(arrival),
+                        'ExpectedDepartureTime': _iso(arrival),
+                        'Extension': {'IsRealTime': True},
+                    },
+                },
+            })
+
+    return {'ServiceDelivery': {
+        'ResponseTimestamp': _iso(now),
+        'ProducerRef': 'CTS',
+        'StopMonitoringDelivery': [{
+            'ResponseTimestamp': _iso(now),
+            'ValidUntil': _iso(now + timedelta(seconds=60)),
+            'ShortestPossibleCycle': 'PT30S',
+            'MonitoredStopVisit': stop_visits,
+        }],
+    }}
+
+
+def refs_of(data):
+    """Références des stations présentes dans une réponse."""
+    refs = []
+    for delivery in data['ServiceDelivery']['StopMonitoringDelivery']:
+        for visit in delivery.get('MonitoredStopVisit', ()):
+            ref = (visit.get('MonitoringRef')
+                    or visit['MonitoredVehicleJourney']['MonitoredCall']
+                    ['StopPointRef'])
+            if ref not in refs:
+                refs.append(ref)
+    return refs
+
+
+def load(paths):
+    """Couples (références, données) des fichiers ou générés."""
+    if not paths:
+        return [(refs, synthetic_response(refs))
+                for refs in (['275A'], ['275A', '275B', '276A', '276B'])]
+    responses = []
+    for path in paths:
+        if path.endswith('.jsonl'):
+            responses.extend((rec['refs'], json.loads(rec['body']))
+                    for rec in siri_replay.load_recordings(path)
+                    if rec['status'] == 200)
+            continue
+        with open(path) as file:
+            data = json.load(file)
+        responses.append((refs_of(data), data))
+    return responses
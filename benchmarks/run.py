@@ -0,0 +1,256 @@
+"""
+Mesure des chemins critiques : récupération, lecture, affichage et
+animation, sur un écran émulé et des réponses enregistrées ou générées.
+
+    python -m benchmarks.run [--payloads réponses.jsonl ...]
+            [--save résultats.json] [--compare précédents.json]
+
+Pour chaque scénario sont relevés par appel : temps réel, temps CPU,
+pic de mémoire allouée pendant l'appel (tracemalloc) et opérations sur
+le bus I2C émulé.
+--compare signale les scénarios plus lents ou plus bavards que ceux
+d'une mesure précédente (code de sortie 1).
+"""
+
+from datetime import datetime, timedelta
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import lcd_animations
+import lcd_display
+import poll_scheduler
+import rpi_i2c_lcd
+import shared_data
+import siri_parser
+from benchmarks import payloads
+from lcd_emulator import EmulatedLCD
+from lcd_glyphs import GlyphCache
+
+THRESHOLD = 0.20            # Écart relatif toléré avant régression
+ALLOC_CALLS = 20            # Appels mesurés sous tracemalloc
+COMPARED = ('wall_us', 'cpu_us', 'bus_bytes')
+
+
+def _lcd(batched=True):
+    return rpi_i2c_lcd.LiquidCrystalI2C(bus=EmulatedLCD(), batched=batched)
+
+
+def scenario_display_string(batched):
+    lcd = _lcd(batched)
+    lines = itertools.cycle([('Homme de F 12:30', 'A:  3m    C: 12m'),
+                             ('Homme de F 12:31', 'A:  2m    C: 11m')])
+
+    def call():
+        header, trams = next(lines)
+        lcd.display_string(header, 1)
+        lcd.display_string(trams, 2)
+    return call, lcd.bus
+
+
+def scenario_full_redraw():
+    lcd = _lcd()
+
+    def call():
+        lcd.invalidate()
+        lcd.display_string('Homme de F 12:30', 1)
+        lcd.display_string('A:  3m    C: 12m', 2)
+    return call, lcd.bus
+
+
+def scenario_dino_frame():
+    lcd = _lcd()
+    animation = lcd_animations.DinoAnimation(lcd, GlyphCache(lcd))
+
+    def call():
+        for _ in animation:
+            return
+        next(animation)
+    return call, lcd.bus
+
+
+def scenario_parse(responses):
+    stations = [ref for refs, _ in responses for ref in refs]
+
+    def call():
+        siri_parser.parse_stop_monitoring(responses, stations)
+    return call, None
+
+
+def scenario_display_refresh(responses):
+    stations = [ref for refs, _ in responses for ref in refs]
+    _, visits = siri_parser.parse_stop_monitoring(responses, stations)
+    now = datetime.now()
+    channels = []
+    for arrivals in visits.values():
+        channel = shared_data.SnapshotChannel()
+        # Arrivées ramenées dans le futur pour être affichées.
+        channel.publish([tram._replace(expected_arriv=now
+            + timedelta(minutes=3 + i)) for i, tram in enumerate(arrivals)])
+        channels.append(channel)
+    display = lcd_display.DisplayThr(channels, threading.Event(), 0, 0,
+            bus=EmulatedLCD())
+
+    def call():
+        display.refresh()
+        display.next_change()
+    return call, display.display.bus
+
+
+def scenario_fetch(responses):
+    try:
+        import infos_tram
+    except ImportError as err:
+        raise RuntimeError('fetch needs {}'.format(err.name))
+    import siri_replay
+
+    fd, path = tempfile.mkstemp(suffix='.jsonl')
+    os.close(fd)
+    recorder = siri_replay.ResponseRecorder(path)
+    for refs, data in responses:
+        recorder.record(refs, 200, json.dumps(data))
+    server = siri_replay.ReplayServer(('127.0.0.1', 0),
+            siri_replay.load_recordings(path), quiet=True)
+    os.remove(path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    refs = responses[-1][0]
+    channels = {ref: shared_data.SnapshotChannel() for ref in refs}
+    # Quota illimité : seules les requêtes sont mesurées.
+    infos = infos_tram.InfosThr(channels, threading.Event(), refs, 'token',
+            poll_scheduler.RequestBudget(10 ** 9, 10 ** 9),
+            'http://127.0.0.1:{}/'.format(server.server_address[1]))
+
+    def call():
+        infos.poll()
+    return call, None
+
+
+def measure(call, bus, number):
+    """Mesures par appel de call."""
+    call()
+    if bus is not None:
+        bus.reset_counters()
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(number):
+        call()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    result = {'calls': number,
+              'wall_us': wall / number * 1e6,
+              'cpu_us': cpu / number * 1e6}
+    if bus is not None:
+        result.update({'bus_transactions': bus.transactions / number,
+                       'bus_bytes': bus.bytes_sent / number,
+                       'bus_us': bus.bus_time / number * 1e6})
+
+    # Pic d'un appel au-delà de la mémoire déjà allouée avant lui, le plus
+    # élevé des ALLOC_CALLS appels.
+    tracemalloc.start()
+    peak = 0
+    for _ in range(ALLOC_CALLS):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        call()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    result['alloc_peak'] = peak
+    tracemalloc.stop()
+    return result
+
+
+def run(paths, quick=False):
+    responses = payloads.load(paths)
+    scale = 10 if quick else 1
+    scenarios = [
+        ('render.display_string', lambda: scenario_display_string(True),
+            2000),
+        ('render.display_string.per_byte',
+            lambda: scenario_display_string(False), 20),
+        ('render.full_redraw', scenario_full_redraw, 1000),
+        ('animation.dino_frame', scenario_dino_frame, 1000),
+        ('parse.stop_monitoring', lambda: scenario_parse(responses), 2000),
+        ('display.refresh', lambda: scenario_display_refresh(responses),
+            2000),
+        ('fetch.poll', lambda: scenario_fetch(responses), 50),
+    ]
+    results = {}
+    for name, setup, number in scenarios:
+        try:
+            call, bus = setup()
+        except RuntimeError as err:
+            print('{:32} skipped: {}'.format(name, err))
+            continue
+        results[name] = measure(call, bus, max(number // scale, 1))
+        print(format_result(name, results[name]))
+    return results
+
+
+def format_result(name, result):
+    line = '{:32} wall {:9.1f} us  cpu {:9.1f} us  alloc peak {:6.0f} B'.format(
+            name, result['wall_us'], result['cpu_us'], result['alloc_peak'])
+    if 'bus_bytes' in result:
+        line += '  i2c {:5.1f} tr {:6.1f} B {:8.1f} us'.format(
+                result['bus_transactions'], result['bus_bytes'],
+                result['bus_us'])
+    return line
+
+
+def compare(results, previous, threshold=THRESHOLD):
+    """Affiche les régressions, renvoie leur nombre."""
+    regressions = 0
+    for name, result in results.items():
+        old = previous['results'].get(name)
+        if old is None:
+            continue
+        for key in COMPARED:
+            if key not in result or not old.get(key):
+                continue
+            ratio = result[key] / old[key]
+            if ratio > 1 + threshold:
+                regressions += 1
+                print('REGRESSION {} {}: {:.1f} -> {:.1f} (x{:.2f})'.format(
+                    name, key, old[key], result[key], ratio))
+    return regressions
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hot paths benchmarks.')
+    parser.add_argument('--payloads', nargs='*', default=[],
+            help='recorded responses (.json or siri_replay .jsonl)')
+    parser.add_argument('--save', help='write results to a JSON file')
+    parser.add_argument('--compare', help='results of a previous run')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+            help='relative slowdown reported as a regression')
+    parser.add_argument('--quick', action='store_true',
+            help='ten times fewer calls')
+    args = parser.parse_args()
+
+    results = run(args.payloads, args.quick)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump({'revision': revision(), 'date': time.time(),
+                       'python': platform.python_version(),
+                       'results': results}, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            if compare(results, json.load(file), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
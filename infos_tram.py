@@ -5,132 +5,317 @@ Gère l'envoie des requêtes au serveur et le partage des données aux
 autres threads.
 """
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import email.utils
 import threading
 import logging
-import re
+import time
 
 import requests
-import shared_data
+import siri_parser
+from metrics import REGISTRY
+from poll_scheduler import PollScheduler, RequestBudget
 
-MIN_DELAY = 30              # Temps minimum avant une nouvelle requête.
-ATTEMPT_DELAY = 14          # Temps d'attente pour une requête non concluante.
-MAX_ATTEMPT = 2             # Nb d'essai avant exit
-SEC_TO_WAKEUP = 5 * 60 * 60 # Temps d'attente si plus de tram
+MAX_REFS_PER_REQUEST = 10   # Nb max de stations par requête
+CONNECT_TIMEOUT = 5         # Temps max d'établissement de la connexion
+READ_TIMEOUT = 15           # Temps max d'attente de la réponse
+MAX_STOP_VISITS = 3         # Nb max d'arrivées par station et par réponse
     
 URL = "https://api.cts-strasbourg.eu/v1/siri/2.0/stop-monitoring"
 
+REQUESTS = REGISTRY.counter('tram_requests_total',
+        'Stop-monitoring requests by HTTP status.')
+FAILURES = REGISTRY.counter('tram_request_failures_total',
+        'Failed polls by reason (http, connection, timeout, invalid, '
+        'request).')
+LATENCY = REGISTRY.histogram('tram_request_duration_seconds',
+        'Stop-monitoring request duration.',
+        (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15))
+RESPONSE_BYTES = REGISTRY.counter('tram_response_bytes_total',
+        'Bytes received from the stop-monitoring service.')
+VALID_UNTIL = REGISTRY.gauge('tram_valid_until_seconds',
+        'Seconds until the ValidUntil of the last response.')
+DATA_AGE = REGISTRY.gauge('tram_data_age_seconds',
+        'Seconds since the arrivals of a station were published.')
+BUDGET_TOKENS = REGISTRY.gauge('tram_budget_tokens',
+        'Requests left in the hourly budget.')
+
 def seconds_left(future):
     return timedelta.total_seconds(future - datetime.now())
 
 
+def retry_after(response):
+    """Délai demandé par l'en-tête Retry-After d'une réponse (secondes
+    ou date HTTP), None sans en-tête valide."""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
 class InfosThr(threading.Thread):
     """Thread de récupération des données.
 
+    Toutes les stations sont interrogées en une seule requête, découpée
+    par groupes de MAX_REFS_PER_REQUEST.
+
     Attributs:
-        shared: liste de données partagées
+        shared: dict, SnapshotChannel des arrivées par référence de station
         stop_event: objet event pour signaler l'arrêt du script
         logger: objet de log
         token: str, token d'identification
-        payload: dict, arguments de la requête GET
-    Argument en plus:
-        station_ref: str, unique référence de la station
+        payloads: list de dict, arguments des requêtes GET
+        session: requests.Session, connexion persistante au serveur
+        validators: dict, ETag, Last-Modified et données de la dernière
+            réponse de chaque requête
+        listeners: fonctions appelées après chaque transfert de données
+        scheduler: PollScheduler, délais entre les interrogations
+        url: adresse du service stop-monitoring
+        recorder: ResponseRecorder enregistrant les réponses, ou None
+        valid_until: datetime, ValidUntil de la dernière réponse
+        cache: ResponseCache de la dernière réponse, ou None
+        history: ArrivalHistory des heures annoncées, ou None
+        model: HeadwayModel complétant les arrivées d'estimations, ou None
+        visits: dict, TramArriv de la dernière réponse par station
+        published: date de la dernière réponse (time.time)
+    Arguments en plus:
+        station_refs: list de str, références uniques des stations
+        budget: RequestBudget, quota de requêtes éventuellement partagé
     """
 
-    def __init__(self, shared, stop_event, station_ref, token):
+    def __init__(self, shared, stop_event, station_refs, token, budget=None,
+            url=URL, recorder=None, cache=None, history=None,
+            model=None):
         threading.Thread.__init__(self)
         self.shared = shared
         self.stop_event = stop_event
         self.logger = logging.getLogger(__name__)
         self.token = token
-        self.payload = {'MonitoringRef': [station_ref],
-                        'VehicleMode': 'tram',
-                        'PreviewInterval': 'PT1H30M',
-                        'MaximumStopVisits': 3}
+        self.payloads = [{'MonitoringRef': station_refs[i:i
+                            + MAX_REFS_PER_REQUEST],
+                          'VehicleMode': 'tram',
+                          'PreviewInterval': 'PT1H30M',
+                          'MaximumStopVisits': MAX_STOP_VISITS}
+                for i in range(0, len(station_refs), MAX_REFS_PER_REQUEST)]
+        self.validators = {}
+        self.listeners = []
+        self.url = url
+        self.recorder = recorder
+        self.scheduler = PollScheduler(budget or RequestBudget(),
+                len(self.payloads))
+        self.valid_until = None
+        self.cache = cache
+        self.history = history
+        self.model = model
+        self.visits = None
+        self.published = None
+        REGISTRY.collector(self.collect_metrics)
 
+        # Une seule connexion réutilisée d'une requête à l'autre.
+        self.session = requests.Session()
+        self.session.auth = (token, '')
+        self.session.headers.update({'Accept': 'application/json',
+                                     'Accept-Encoding': 'gzip, deflate'})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                pool_maxsize=1)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
-    def run(self):
-        local_list = []
-        shared_list = self.shared.list
-        req_try = 0
-        req = None
+    def fetch(self, payload):
+        """Requête GET, conditionnelle si le serveur le permet.
+
+        Renvoie les données JSON de la réponse, celles de la réponse
+        précédente si le serveur indique qu'elles n'ont pas changé.
+        """
+        key = tuple(payload['MonitoringRef'])
+        headers = {}
+        etag, modified, data = self.validators.get(key, (None, None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+
+        start = time.perf_counter()
+        self.scheduler.budget.consume()
+        req = self.session.get(self.url, params=payload, headers=headers,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        elapsed = time.perf_counter() - start
+        LATENCY.observe(elapsed)
+        REQUESTS.inc(status=req.status_code)
+        RESPONSE_BYTES.inc(len(req.content))
+        self.logger.debug('GET %s: %d in %.1f ms, %d bytes.', ','.join(key),
+                req.status_code, elapsed * 1000, len(req.content))
 
+        if req.status_code == requests.codes.not_modified and data:
+            return data
+        req.raise_for_status()
+        if self.recorder is not None:
+            self.recorder.record(key, req.status_code, req.text)
+        data = req.json()
+        etag = req.headers.get('ETag')
+        modified = req.headers.get('Last-Modified')
+        if etag or modified:
+            self.validators[key] = (etag, modified, data)
+        return data
+
+    def load_cache(self):
+        """Publie les arrivées de la réponse conservée, si ce n'est déjà
+        fait.
+
+        Renvoie le délai avant la première interrogation : le temps de
+        validité restant de la réponse conservée, 0 sans elle.
+        """
+        if self.cache is None:
+            return 0
+        valid_until = self.cache.restore(self.shared)
+        for listener in self.listeners:
+            listener()
+        if valid_until is None:
+            return 0
+        self.valid_until = valid_until
+        return max(0, seconds_left(valid_until))
+
+    def close(self):
+        self.session.close()
+
+    def run(self):
+        if self.stop_event.wait(timeout=self.load_cache()):
+            self.close()
+            return
         while True:
-            try:
-                req = requests.get(URL, auth=(self.token,''),
-                        params=self.payload)
-                if req.status_code == requests.codes.all_ok:
-                    req_try = 0
-                else:
-                    req.raise_for_status()
-
-            except requests.exceptions.HTTPError:
-                self.logger.exception('Request error %d.', req.status_code,
-                        exc_info=False)
-                if self.stop_event.wait(timeout=MIN_DELAY):
-                    break
-
-            # Si erreur, alors retentative jusqu'à MAX_ATTEMPT fois.
-            except requests.exceptions.ConnectionError:
-                self.logger.exception('Connection error. Attempt %d.', req_try,
-                        exc_info=False)
-
-                if req_try < MAX_ATTEMPT:
-                    req_try = req_try + 1
-                    self.stop_event.wait(timeout=ATTEMPT_DELAY)
-                    continue
-                else:
-                    self.logger.exception('Hanging up.', exc_info=False)
-                    self.stop_event.set()
-                    break
-
-            data = req.json()
-
-            # Remove UTC offset at the end of string.
-            valid_until_str = re.sub(r"^(.*)(\+|\-).*", r"\1",
-                    (data['ServiceDelivery']['StopMonitoringDelivery'][0]
-                    ['ValidUntil']), flags=re.ASCII)
-
-            # Secondes restantes pour une nouvelle requête
-            valid_cntdown = seconds_left(datetime.strptime(valid_until_str,
-                '%Y-%m-%dT%H:%M:%S'))
-
-            # Tableau comprenant noms de ligne et heures d'arrivées.
-            # Si une exception est levée, plus aucun tram n'est
-            # attendu.
-            try:
-                tram_infos = (data['ServiceDelivery']['StopMonitoringDelivery']
-                    [0]['MonitoredStopVisit'])
-            except KeyError:
-                self.logger.warning('End of arrivals. Waiting %d seconds.',
-                        SEC_TO_WAKEUP)
-                if self.stop_event.wait(timeout=SEC_TO_WAKEUP):
-                    break
-                continue
-
-            # Remplissage tableau.
-            for i, val in enumerate(tram_infos):
-                # Remove UTC offset at the end of string.
-                valid_until_str = re.sub(r"^(.*)(\+|\-).*", r"\1",
-                        (val['MonitoredVehicleJourney']['MonitoredCall']
-                            ['ExpectedArrivalTime']), flags=re.ASCII)
-                arrival_time = datetime.strptime(valid_until_str , '%Y-%m-%dT%H:%M:%S')
-                line_ref = val['MonitoredVehicleJourney']['LineRef']
-                destination = (val['MonitoredVehicleJourney']
-                        ['DestinationShortName'])
-                station = (val['MonitoredVehicleJourney']['MonitoredCall']
-                        ['StopPointName'])
-                try:
-                    local_list[i] = shared_data.TramArriv(line_ref,
-                            arrival_time, destination, station)
-                except IndexError:
-                    local_list.append(shared_data.TramArriv(line_ref,
-                        arrival_time, destination, station))
-
-            # Transfert des données.
-            with self.shared.lock:
-                shared_data.copy_list(local_list, shared_list)
-
-            # Temps minimum pour éviter la saturation.
-            if self.stop_event.wait(timeout=(valid_cntdown + MIN_DELAY)):
+            delay = self.poll()
+            if delay is None or self.stop_event.wait(timeout=delay):
                 break
+
+        self.close()
+
+    def poll(self):
+        """Interroge le serveur et transfère les données.
+
+        Renvoie le délai avant la prochaine interrogation.
+        """
+        responses = []
+        try:
+            for payload in self.payloads:
+                responses.append((payload['MonitoringRef'],
+                    self.fetch(payload)))
+
+        # Si erreur, alors retentative avec un délai croissant.
+        # 429 ou 503 : le serveur peut indiquer quand revenir.
+        except requests.exceptions.HTTPError as err:
+            FAILURES.inc(reason='http')
+            delay = self.scheduler.retry_delay(retry_after(err.response))
+            self.logger.exception('Request error %d. Retry in %d seconds.',
+                    err.response.status_code, delay, exc_info=False)
+            self.publish_estimates()
+            return delay
+
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as err:
+            FAILURES.inc(reason='timeout' if isinstance(err,
+                requests.exceptions.Timeout) else 'connection')
+            delay = self.scheduler.retry_delay()
+            self.logger.exception(
+                    'Connection error. Attempt %d, retry in %d seconds.',
+                    self.scheduler.failures, delay, exc_info=False)
+            self.publish_estimates()
+            return delay
+
+        # Réponse qui n'est pas du JSON (page d'erreur d'un proxy...).
+        except ValueError:
+            FAILURES.inc(reason='invalid')
+            delay = self.scheduler.retry_delay()
+            self.logger.exception('Invalid response. Retry in %d seconds.',
+                    delay, exc_info=False)
+            self.publish_estimates()
+            return delay
+
+        # Autres erreurs de requests (redirections, décodage gzip...).
+        except requests.exceptions.RequestException as err:
+            FAILURES.inc(reason='request')
+            delay = self.scheduler.retry_delay()
+            self.logger.exception('Request failed (%s). Retry in %d seconds.',
+                    err, delay, exc_info=False)
+            self.publish_estimates()
+            return delay
+
+        # Noms de ligne et heures d'arrivées par station.
+        try:
+            valid_until, visits = siri_parser.parse_stop_monitoring(
+                    responses, self.shared)
+        except (KeyError, TypeError, ValueError) as err:
+            FAILURES.inc(reason='invalid')
+            delay = self.scheduler.retry_delay()
+            self.logger.exception('Malformed response (%r). Retry in %d '
+                    'seconds.', err, delay, exc_info=False)
+            self.publish_estimates()
+            return delay
+        self.valid_until = valid_until
+        if self.cache is not None:
+            self.cache.save(responses, valid_until)
+        if self.history is not None:
+            self.history.record(visits)
+        # Secondes restantes pour une nouvelle requête
+        valid_cntdown = seconds_left(valid_until) if valid_until else 0
+
+        next_arrival = min((seconds_left(arrival.expected_arriv)
+                for arrivals in visits.values() for arrival in arrivals
+                if arrival.expected_arriv > datetime.now()), default=None)
+
+        # Transfert des données, y compris aux stations sans tram.
+        self.visits = visits
+        self.published = time.time()
+        if self.model is not None:
+            self.model.learn(visits, datetime.now())
+        self.publish(visits, self.published)
+
+        if not any(visits.values()):
+            delay = self.scheduler.next_delay(valid_cntdown, None)
+            self.logger.warning('End of arrivals. Waiting %d seconds.', delay)
+            return delay
+
+        # Rapproché si un tram arrive bientôt, dans la limite du quota.
+        return self.scheduler.next_delay(valid_cntdown, next_arrival)
+
+    def publish(self, visits, published, stale=False):
+        """Transfère les arrivées.
+
+        Elles ne sont complétées des estimations du modèle qu'une fois
+        expirées (stale) ou si la réponse a été tronquée à MAX_STOP_VISITS :
+        après le dernier tram du service, l'écran se vide.
+        """
+        now = datetime.now()
+        for ref, arrivals in visits.items():
+            if self.model is not None and (stale
+                    or len(arrivals) >= MAX_STOP_VISITS):
+                arrivals = self.model.extend(ref, arrivals, now, stale)
+            self.shared[ref].publish(arrivals, published)
+        for listener in self.listeners:
+            listener()
+
+    def publish_estimates(self):
+        """Après un échec, prolonge les estimations à partir de la
+        dernière réponse, elle-même estimée une fois expirée."""
+        if self.model is None or self.visits is None:
+            return
+        stale = self.valid_until is None or self.valid_until < datetime.now()
+        self.publish(self.visits, self.published, stale)
+
+    def collect_metrics(self):
+        """Mesures lues à la demande (validité, âge des données, quota)."""
+        if self.valid_until is not None:
+            yield VALID_UNTIL.name, {}, seconds_left(self.valid_until)
+        now = time.time()
+        for ref, channel in self.shared.items():
+            published = channel.snapshot.published
+            if published is not None:
+                yield DATA_AGE.name, {'station': ref}, now - published
+        yield BUDGET_TOKENS.name, {}, self.scheduler.budget.available()
@@ -1,7 +1,16 @@
 """
 Animations sur écran lcd 16x2.
+
+Une animation est décrite par une suite d'images (Frame). Elle est
+compilée une seule fois en flux d'octets ne contenant que les
+différences d'une image à l'autre, puis rejouée telle quelle à chaque
+pas : le coût d'une image se limite alors à l'écriture sur le bus.
 """
 
+from collections import namedtuple
+import rpi_i2c_lcd as lcd
+from lcd_glyphs import CGRAM_SLOTS
+
 waves = [ [ 0x03, 0x04, 0x08, 0x10, 0x00, 0x00, 0x00, 0x00 ],
         [ 0x18, 0x04, 0x02, 0x01, 0x00, 0x00, 0x00, 0x00 ],
         [ 0x00, 0x00, 0x00, 0x00, 0x10, 0x08, 0x04, 0x03 ],
@@ -27,47 +36,185 @@ dinosaure_right_foot = [
         [ 0x1F, 0x1F, 0x1F, 0x1F, 0x16, 0x03, 0x00, 0x00 ]
     ]
 
+Frame = namedtuple('Frame', 'rows glyphs')
+Frame.__doc__ = """Image de l'écran.
+
+rows: chaînes, une par ligne, chr(0) à chr(7) désignant glyphs[0] à
+    glyphs[7]
+glyphs: motifs des caractères personnalisés utilisés par l'image
+"""
+
+# Pas compilé : index du flux, cellules écrites, glyphes chargés et
+# compteur d'adresse DDRAM final (None si en CGRAM, flux vide si None).
+_Step = namedtuple('_Step', 'buffer cells cgram ddram_addr')
+
+
+def _used_glyphs(frame):
+    return set(tuple(frame.glyphs[ord(char)])
+            for row in frame.rows for char in row if ord(char) < CGRAM_SLOTS)
+
+
+class CompiledAnimation:
+    """Animation précompilée en flux d'octets dédupliqués.
+
+    Attributs:
+        steps: pas de chaque image depuis un écran inconnu pour la
+            première, depuis l'image précédente pour les autres
+        loop: pas de la première image depuis la dernière
+        buffers: opérations (valeur, drapeaux) de chaque flux distinct
+    """
+
+    def __init__(self, frames):
+        self.buffers = []
+        self._buffer_index = {}
+        self._encoded = {}
+        self.steps = []
+
+        needs = [_used_glyphs(frame) for frame in frames]
+        slots = [None] * CGRAM_SLOTS
+        cells = {}
+        for i, frame in enumerate(frames):
+            mapping, cgram = self._allocate(slots, needs, i)
+            cells, step = self._compile(frame, mapping, cgram, cells)
+            self.steps.append(step)
+            if i == 0:
+                first_mapping = mapping
+
+        # Retour à la première image : ses glyphes doivent retrouver
+        # leurs emplacements pour que la suite reste valable.
+        cgram = [(slot, glyph) for glyph, slot in first_mapping.items()
+                if slots[slot] != glyph]
+        _, self.loop = self._compile(frames[0], first_mapping, cgram, cells)
+
+    def __len__(self):
+        return len(self.steps)
+
+    @staticmethod
+    def _allocate(slots, needs, index):
+        """Emplacements des glyphes de l'image index, en évinçant ceux
+        réutilisés le plus tard (slots est mis à jour)."""
+        need = needs[index]
+        mapping = {glyph: slots.index(glyph) for glyph in need
+                if glyph in slots}
+        cgram = []
+
+        def next_use(glyph):
+            for dist in range(1, len(needs) + 1):
+                if glyph in needs[(index + dist) % len(needs)]:
+                    return dist
+            return len(needs) + 1
+
+        for glyph in sorted(need - mapping.keys()):
+            free = [slot for slot, held in enumerate(slots)
+                    if held is None or held not in need]
+            slot = max(free, key=lambda slot: (slots[slot] is None,
+                next_use(slots[slot])))
+            slots[slot] = glyph
+            mapping[glyph] = slot
+            cgram.append((slot, glyph))
+        return mapping, cgram
+
+    def _compile(self, frame, mapping, cgram, prev_cells):
+        ops = []
+        for slot, glyph in cgram:
+            ops.append((lcd.SETCGRAMADDR | (slot * 8), 0x0))
+            ops.extend((line, lcd.RS) for line in glyph)
+
+        cells = {}
+        for line, row in enumerate(frame.rows):
+            for col, char in enumerate(row):
+                code = ord(char)
+                if code < CGRAM_SLOTS:
+                    code = mapping[tuple(frame.glyphs[code])]
+                cells[lcd.LINE_OFFSETS[line] + col] = code
+
+        written = []
+        ddram_addr = None
+        for addr in sorted(cells):
+            if prev_cells.get(addr) == cells[addr]:
+                continue
+            if addr != ddram_addr:
+                ops.append((lcd.SETDDRAMADDR | addr, 0x0))
+            ops.append((cells[addr], lcd.RS))
+            written.append((addr, cells[addr]))
+            ddram_addr = lcd.next_ddram_addr(addr)
+
+        if not ops:
+            return cells, _Step(None, (), (), None)
+
+        ops = tuple(ops)
+        if ops not in self._buffer_index:
+            self._buffer_index[ops] = len(self.buffers)
+            self.buffers.append(ops)
+        return cells, _Step(self._buffer_index[ops], tuple(written),
+                tuple(cgram), ddram_addr)
+
+    def encoded(self, bkl):
+        """Flux d'octets prêts à l'envoi pour un état du rétroéclairage."""
+        if bkl not in self._encoded:
+            self._encoded[bkl] = [b''.join(lcd.encode(value, flags, bkl)
+                for value, flags in ops) for ops in self.buffers]
+        return self._encoded[bkl]
+
+    def replay(self, display, index, glyphs=None, resume=False):
+        """Affiche l'image index, depuis la dernière image si resume."""
+        step = self.loop if resume and index == 0 else self.steps[index]
+        if step.buffer is None:
+            return
+        if not display.curs_inc or display.disp_move:
+            display.entry_mode_set(cursor_inc=True, display_move=False)
+        display.write_raw(self.encoded(display.bkl)[step.buffer],
+                step.cells, step.ddram_addr)
+        if glyphs is not None:
+            for slot, glyph in step.cgram:
+                glyphs.assume(slot, glyph)
+
+
+def dino_frames(cols=16, positions=20):
+    """Images du dinosaure traversant l'écran de gauche à droite."""
+    frames = []
+    for pos in range(positions):
+        glyphs = (static_dinosaure[:4]
+                + [dinosaure_left_foot[pos % 2], dinosaure_right_foot[pos % 2],
+                    static_dinosaure[6]])
+        rows = [[' '] * cols, [' '] * cols]
+        for line, start, codes in ((0, pos, (3, 2, 1, 0)),
+                (1, pos - 1, (6, 5, 4))):
+            for offset, code in enumerate(codes):
+                if 0 <= start - offset < cols:
+                    rows[line][start - offset] = chr(code)
+        frames.append(Frame([''.join(row) for row in rows], glyphs))
+    return frames
+
+
 class DinoAnimation:
+    """Itérateur affichant une traversée du dinosaure, une image par pas."""
 
-    def __init__(self, display) -> None:
+    def __init__(self, display, glyphs=None, cols=16) -> None:
         self.display = display
-        self.frame_index = 0
+        self.glyphs = glyphs
         self.cur_position = 0
         self.MAX_COL_POSITION = 20
-        display.load_custom_chars(static_dinosaure)
+        self.animation = CompiledAnimation(dino_frames(cols,
+            self.MAX_COL_POSITION))
+        self._end_mark = None
 
     def __iter__(self):
         return self
 
     def __next__(self):
         if self.cur_position == self.MAX_COL_POSITION:
-            self.display.entry_mode_set(cursor_inc=True)
             self.cur_position = 0
             raise StopIteration
 
-        self.display.entry_mode_set(cursor_inc=False)
-        self._step()
-        self._draw_cells()
-        self.display.entry_mode_set(cursor_inc=True)
+        # Écran inchangé depuis la dernière image si rien n'a été envoyé
+        # entre temps, sinon l'animation reprend à la première image,
+        # complète (glyphes et cellules).
+        touched = self._end_mark != self.display.bytes_sent
+        if touched:
+            self.cur_position = 0
+        resume = self.cur_position == 0 and not touched
+        self.animation.replay(self.display, self.cur_position, self.glyphs,
+                resume)
+        self._end_mark = self.display.bytes_sent
         self.cur_position += 1
-
-    def _step(self) -> None:
-        self.display.entry_mode_set(cursor_inc=True)
-        self.display.load_single_custom_char(4, dinosaure_left_foot[self.frame_index])
-        self.display.load_single_custom_char(5, dinosaure_right_foot[self.frame_index])
-        self.display.entry_mode_set(cursor_inc=False)
-        self.frame_index ^= 1
-
-    def _draw_cells(self):
-        self.display.set_cursor_at(self.cur_position)
-        for i in range(3, -1, -1):
-            self.display.write_char(i)
-
-        self.display.write_char(ord(' '))
-
-        self.display.set_cursor_at(0x40 + self.cur_position - 1)
-        for i in range(6, 3, -1):
-            self.display.write_char(i)
-
-        self.display.write_char(ord(' '))
-
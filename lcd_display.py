@@ -1,45 +1,219 @@
 """
 Traitement le l'affichage des horaires et des lignes de tram.
 
-Le module est adapté à un écran lcd 16x2 mais est compatible avec tout
-autre taille en apportant de légères modifications.
+Le module est adapté aux écrans lcd 16x2 et 20x4. Sur un écran 4 lignes,
+chaque arrivée est affichée avec sa destination. Les minutes d'une
+arrivée estimée localement sont précédées d'un tilde au lieu de : (A~  5m),
+caractère personnalisé, 0x7E étant une flèche dans la ROM de l'écran.
 """
 
 from datetime import datetime, timedelta
+import heapq
 import sys
+import time
 import logging
 import threading
 import rpi_i2c_lcd
-import shared_data
+from lcd_glyphs import GlyphCache
+from lcd_marquee import Marquee, marquee_rows
+from metrics import REGISTRY
 import lcd_animations as anim
 
-REFRESH_TIME = 1    # Rafraîchit l'écran toutes les secondes
+REFRESH_TIME = 1    # Attente après une animation
 ANIM_REFRESH_TIME = 0.35 # Pour l'animation
+STATION_CYCLE_TIME = 5  # Alternance entre stations toutes les 5 secondes
+ROLLOVER_MARGIN = timedelta(milliseconds=10) # Réveil juste après un changement
+IDLE_ANIMATION = 10 * 60    # Animation pendant 10 minutes au plus sans tram
+STATIC_REFRESH = 10 * 60    # Écran de veille réécrit toutes les 10 minutes
+TILDE = (0b00000, 0b00000, 0b01000, 0b10101, 0b00010, 0b00000, 0b00000,
+         0b00000)   # Marque des arrivées estimées
+
+REFRESH_DURATION = REGISTRY.histogram('lcd_refresh_duration_seconds',
+        'Time to render the arrivals screen.',
+        (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+SHOWN_AGE = REGISTRY.gauge('lcd_shown_data_age_seconds',
+        'Seconds since the arrivals on screen were published.')
+I2C_TRANSACTIONS = REGISTRY.counter('lcd_i2c_transactions_total',
+        'I2C transactions sent to the LCD.')
+I2C_BYTES = REGISTRY.counter('lcd_i2c_bytes_total',
+        'Bytes sent to the LCD I2C expander.')
+I2C_SAVED = REGISTRY.counter('lcd_i2c_transactions_saved_total',
+        'I2C transactions not sent thanks to the shadow DDRAM.')
 
 def minutes_left(arrival_time):
     """Calcule des minutes restantes entre arrival_time et maintenant."""
     return int(timedelta.total_seconds(arrival_time - datetime.now()) // 60)
 
 
+def next_rollover(arrival_time, now):
+    """Instant où minutes_left(arrival_time) diminuera, None si passé."""
+    seconds = timedelta.total_seconds(arrival_time - now)
+    if seconds < 0:
+        return None
+    return now + timedelta(seconds=seconds % 60) + ROLLOVER_MARGIN
+
+
+class ChangeSchedule:
+    """Prochains instants où l'écran affiché change.
+
+    Un tas contient pour chaque arrivée publiée l'instant où ses minutes
+    restantes diminuent, il n'est reconstruit qu'à la publication d'une
+    nouvelle version. S'y ajoutent la minute suivante de l'horloge et,
+    si plusieurs stations s'affichent à tour de rôle, leur alternance.
+
+    Attributs:
+        heap: tas de tuples (instant, heure d'arrivée)
+        versions: versions des publications ayant servi au tas
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.versions = None
+
+    def update(self, channels):
+        """Reconstruit le tas si une nouvelle version a été publiée."""
+        versions = tuple(channel.snapshot.version for channel in channels)
+        if versions == self.versions:
+            return
+        self.versions = versions
+        now = datetime.now()
+        self.heap = [(next_rollover(itr.expected_arriv, now),
+            itr.expected_arriv) for channel in channels
+            for itr in channel.snapshot.arrivals if itr.expected_arriv > now]
+        heapq.heapify(self.heap)
+
+    def next_change(self, cycling=False):
+        """Secondes avant le prochain changement de l'écran."""
+        now = datetime.now()
+        while self.heap and self.heap[0][0] <= now:
+            _, arrival_time = heapq.heappop(self.heap)
+            rollover = next_rollover(arrival_time, now)
+            if rollover is not None:
+                heapq.heappush(self.heap, (rollover, arrival_time))
+
+        change = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        if self.heap:
+            change = min(change, self.heap[0][0])
+        delay = timedelta.total_seconds(change - now)
+        if cycling:
+            delay = min(delay,
+                    STATION_CYCLE_TIME - time.monotonic() % STATION_CYCLE_TIME)
+        return delay
+
+
+def valid_arrivals(arrivals, count=2, lines=None, mark='~'):
+    """Tuples (nom_de_ligne, minutes_restantes, destination, séparateur)
+    des count premiers horaires valides (valeurs positives), arrivals
+    étant trié par heure d'arrivée.
+
+    count: nb d'horaires, tous si None
+    lines: lignes retenues, toutes par défaut
+    mark: séparateur des arrivées estimées, : pour les autres
+    """
+    filt_list = []
+    for itr in arrivals:
+        if lines and itr.line_ref not in lines:
+            continue
+        min_left = minutes_left(itr.expected_arriv)
+        if min_left >= 0:
+            filt_list.append((itr.line_ref, min_left, itr.destination,
+                mark if itr.estimated else ':'))
+            if len(filt_list) == count:
+                break
+    return filt_list
+
+
+class IdlePolicy:
+    """Comportement de l'écran en l'absence de tram.
+
+    L'animation n'est jouée que dans les plages horaires données et
+    pendant max_animation secondes au plus. Ensuite l'écran de veille,
+    fixe, s'affiche rétroéclairage éteint jusqu'aux prochaines arrivées.
+
+    Attributs:
+        windows: couples (début, fin) de datetime.time des plages où
+            l'animation est permise, toute la journée si vide
+        max_animation: durée maximum de l'animation (secondes), None sans
+            limite
+        blank: éteindre aussi l'affichage en veille
+        since: début de l'absence de tram ou de la plage en cours
+            (time.monotonic), ou None
+        inside: l'heure était dans une plage au dernier appel d'animate
+    """
+
+    def __init__(self, windows=(), max_animation=IDLE_ANIMATION, blank=False):
+        self.windows = windows
+        self.max_animation = max_animation
+        self.blank = blank
+        self.since = None
+        self.inside = False
+
+    def in_window(self, now=None):
+        """L'heure now (maintenant par défaut) est dans une plage."""
+        if not self.windows:
+            return True
+        now = (now or datetime.now()).time()
+        for start, end in self.windows:
+            if start <= end:
+                if start <= now < end:
+                    return True
+            elif now >= start or now < end:
+                # Plage passant minuit.
+                return True
+        return False
+
+    def animate(self):
+        """L'animation peut être jouée, l'absence de tram commençant au
+        premier appel. L'ouverture d'une plage relance max_animation."""
+        now = time.monotonic()
+        inside = self.in_window()
+        if self.since is None or inside and not self.inside:
+            self.since = now
+        self.inside = inside
+        if self.max_animation is not None and \
+                now - self.since >= self.max_animation:
+            return False
+        return inside
+
+    def reset(self):
+        """Des trams sont affichés."""
+        self.since = None
+        self.inside = False
+
+
 # A MODIFIER POUR ÉCRAN DIFFÉRENT
-def display_header(display, station_name):
+def display_header(display, station_name, cols=16):
     """Affichage nom de station et heure."""
-    display.display_string("{:10.10} {:%H:%M}".format(
-        station_name, datetime.now()), 1)
+    return display.display_string("{:{width}.{width}} {:%H:%M}".format(
+        station_name, datetime.now(), width=cols - 6), 1)
 
 
 def display_one_tramway(display, info_list):
     """Affichage temps restant pour un tram."""
-    display.display_string("{}:{:3}m".format(
-        info_list[0][0], info_list[0][1])
+    return display.display_string("{}{}{:3}m".format(
+        info_list[0][0], info_list[0][3], info_list[0][1])
         + " " * 10, 2)
 
 
 def display_two_tramways(display, info_list):
     """Affichage temps restant pour deux trams."""
-    display.display_string("{}:{:3}m    {}:{:3}m".format(
-        info_list[0][0], info_list[0][1],
-        info_list[1][0], info_list[1][1]), 2)
+    return display.display_string("{}{}{:3}m    {}{}{:3}m".format(
+        info_list[0][0], info_list[0][3], info_list[0][1],
+        info_list[1][0], info_list[1][3], info_list[1][1]), 2)
+
+
+def display_arrival_rows(display, info_list, rows=4, cols=20):
+    """Affichage d'un tram par ligne avec sa destination, sous l'en-tête."""
+    saved = 0
+    for row in range(2, rows + 1):
+        text = ''
+        if row - 2 < len(info_list):
+            line_ref, min_left, destination, mark = info_list[row - 2]
+            text = "{}{}{:3}m {}".format(line_ref, mark, min_left,
+                    destination)
+        saved += display.display_string(
+                "{:{width}.{width}}".format(text, width=cols), row)
+    return saved
 
 
 class DisplayThr(threading.Thread):
@@ -47,68 +221,118 @@ class DisplayThr(threading.Thread):
 
     Attributs:
         display: LiquidCrystalI2C
+        glyphs: GlyphCache, caractères personnalisés de l'écran
+        idle_animation: animation affichée en l'absence de tram
+        idle: IdlePolicy, animation ou veille en l'absence de tram
+        schedule: ChangeSchedule, instants des prochains changements
+        cycling: plusieurs stations s'affichent à tour de rôle
+        wakeup: event réveillant le thread (nouvelles données, arrêt)
+        lines: lignes affichées, None pour toutes
+        rows, cols: taille de l'écran (16x2 ou 20x4)
+        marquee: Marquee faisant défiler toutes les arrivées (16x2), ou None
+        all_arrivals: afficher toutes les arrivées, par défilement sur
+            16x2 ou par pages successives sur 20x4
+        labels: étiquettes des mesures de l'écran
+        listeners: fonctions appelées après chaque affichage d'arrivées
+        shown: date de publication des arrivées affichées, ou None
         logger: objet de log
-        shared: liste de données partagées
+        shared: SnapshotChannel des arrivées, un par station
         stop_event: objet event pour signaler l'arrêt du script
     Argument en plus:
         i2c_addr: adresse du module i2c
         i2c_bus: bus i2c du rpi
+        batched: envoi par blocs, sinon octet par octet
+        bus: bus i2c à utiliser à la place de i2c_bus (ex: écran émulé)
     """
-    def __init__(self, shared, stop_event, i2c_addr, i2c_bus):
+    def __init__(self, shared, stop_event, i2c_addr, i2c_bus, batched=True,
+            bus=None, lines=None, rows=2, cols=16, marquee=False,
+            idle=None):
         threading.Thread.__init__(self)
         self.logger = logging.getLogger(__name__)
         self.shared = shared
         self.stop_event = stop_event
         try:
-            self.display = rpi_i2c_lcd.LiquidCrystalI2C(i2c_addr, i2c_bus)
+            self.display = rpi_i2c_lcd.LiquidCrystalI2C(i2c_addr, i2c_bus,
+                    batched, bus)
         except OSError:
             self.logger.exception('Unconnected device.', exc_info=False)
             self.stop_event.set()
             sys.exit()
+        self.glyphs = GlyphCache(self.display)
+        self.idle_animation = anim.DinoAnimation(self.display, self.glyphs,
+                cols)
+        self.idle = idle or IdlePolicy()
+        self.schedule = ChangeSchedule()
+        self.cycling = False
+        self.wakeup = threading.Event()
+        self.shown = None
+        self.lines = lines
+        self.rows = rows
+        self.cols = cols
+        self.all_arrivals = marquee
+        # Le décalage matériel n'est utilisable que sur 2 lignes.
+        self.marquee = Marquee(self.display, cols) if marquee and rows == 2 \
+                else None
+        self.labels = {'addr': hex(i2c_addr), 'bus': str(i2c_bus)}
+        self.listeners = []
+        REGISTRY.collector(self.collect_metrics)
 
+    def splash(self, message='Chargement...'):
+        """Écran d'attente, avant les premières données."""
+        display_header(self.display, 'Tram', self.cols)
+        self.display.display_string('{:^{width}.{width}}'.format(message,
+            width=self.cols), 2)
+
+    def wake(self):
+        """Rallume l'écran mis en veille."""
+        if not self.display.disp:
+            self.display.display_control(display=True)
+        if not self.display.bkl:
+            self.display.backlight(True)
+
+    def idle_screen(self):
+        """En l'absence de tram, renvoie True si l'animation doit être
+        jouée, sinon affiche l'écran de veille et renvoie False."""
+        if self.idle.animate():
+            self.wake()
+            # L'animation n'occupe que les deux premières lignes.
+            for row in range(3, self.rows + 1):
+                self.display.display_string(' ' * self.cols, row)
+            return True
+        # Réécriture sans effet si l'écran est déjà affiché.
+        self.display.display_string('{:^{width}.{width}}'.format(
+            'Pas de tram', width=self.cols), 1)
+        for row in range(2, self.rows + 1):
+            self.display.display_string(' ' * self.cols, row)
+        if self.display.bkl:
+            self.logger.info('No arrival, display asleep.')
+            self.display.backlight(False)
+        if self.idle.blank and self.display.disp:
+            self.display.display_control(display=False)
+        return False
+
+    def notify(self):
+        """Réveille le thread, à appeler à chaque publication ou à l'arrêt."""
+        self.wakeup.set()
 
     def run(self):
-        local_list = []
-        shared_list = self.shared.list
-        filt_list = [] # Tableau de tuples (nom_de_ligne, minutes_restantes)
-
-        idle_animation = anim.DinoAnimation(self.display)
-
-        while True:
-            # Copie des données partagées
-            with self.shared.lock:
-                shared_data.copy_list(shared_list, local_list)
-
-            # Filtrage pour ne retenir que les horaires valides (valeurs
-            # positives)
-            i = 0
-            for itr in local_list:
-                min_left = minutes_left(itr.expected_arriv)
-
-                if min_left >= 0:
-                    try:
-                        filt_list[i] = (itr.line_ref, min_left)
-                    except IndexError:
-                        filt_list.append((itr.line_ref, min_left))
-                    finally:
-                        i = i + 1
+        while not self.stop_event.is_set():
+            self.wakeup.clear()
             try:
-                # Nothing to disclose, idle
-                if i == 0:
+                if self.refresh():
+                    # Sommeil jusqu'au prochain changement visible.
+                    delay = self.next_change()
+                elif self.idle_screen():
+                    # Nothing to disclose, idle
                     # Frames drawned by iterator
-                    for _ in idle_animation:
-                        if self.stop_event.wait(timeout=ANIM_REFRESH_TIME):
+                    for _ in self.idle_animation:
+                        if self.wakeup.wait(timeout=ANIM_REFRESH_TIME) \
+                                or not self.idle.animate():
                             break
-
+                    delay = REFRESH_TIME
                 else:
-                    # Tri de précaution, garantit stable
-                    filt_list.sort(key=lambda tram: tram[1])
-                    self.display.set_cursor_at(0)
-                    display_header(self.display, local_list[0].station)
-                    if i == 1:
-                        display_one_tramway(self.display, filt_list)
-                    else:
-                        display_two_tramways(self.display, filt_list)
+                    # Veille jusqu'aux prochaines arrivées.
+                    delay = STATIC_REFRESH
 
             except OSError:
                 self.logger.exception('Connection error. Abort.',
@@ -116,5 +340,77 @@ class DisplayThr(threading.Thread):
                 self.stop_event.set()
                 break
 
-            if self.stop_event.wait(timeout=REFRESH_TIME):
-                break
+            self.wakeup.wait(timeout=delay)
+
+    def next_change(self):
+        """Secondes avant le prochain changement de l'écran affiché."""
+        self.schedule.update(self.shared)
+        delay = self.schedule.next_change(self.cycling)
+        step = self.marquee and self.marquee.next_step()
+        return min(delay, step) if step else delay
+
+    def refresh(self):
+        """Affiche les arrivées, renvoie False s'il n'y en a aucune."""
+        start = time.perf_counter()
+        per_screen = 2 if self.rows == 2 else self.rows - 1
+        count = None if self.all_arrivals else per_screen
+        # Tilde chargé en CGRAM seulement si des arrivées sont estimées.
+        mark = None
+        # Stations ayant des horaires valides
+        shown = []
+        for channel in self.shared:
+            # Lecture sans copie ni verrou
+            snapshot = channel.snapshot
+            if mark is None and any(itr.estimated
+                    for itr in snapshot.arrivals):
+                mark = chr(self.glyphs.slot_for(TILDE))
+            filt_list = valid_arrivals(snapshot.arrivals, count, self.lines,
+                    mark)
+            if filt_list:
+                shown.append((snapshot.arrivals[0].station, filt_list,
+                    snapshot.published))
+        if not shown:
+            self.shown = None
+            self.cycling = False
+            if self.marquee:
+                self.marquee.reset()
+            return False
+
+        self.idle.reset()
+        self.wake()
+        if self.marquee:
+            # Toutes les stations défilent ensemble.
+            self.cycling = False
+            self.shown = min(published for _, _, published in shown)
+            saved = self.marquee.draw(marquee_rows([(station, filt_list)
+                for station, filt_list, _ in shown], datetime.now()))
+        else:
+            # Les stations (pages d'arrivées) s'affichent à tour de rôle.
+            screens = [(station, filt_list[i:i + per_screen], published)
+                    for station, filt_list, published in shown
+                    for i in range(0, len(filt_list), per_screen)]
+            self.cycling = len(screens) > 1
+            station, filt_list, self.shown = screens[int(time.monotonic()
+                // STATION_CYCLE_TIME) % len(screens)]
+            saved = display_header(self.display, station, self.cols)
+            if self.rows > 2:
+                saved += display_arrival_rows(self.display, filt_list,
+                        self.rows, self.cols)
+            elif len(filt_list) == 1:
+                saved += display_one_tramway(self.display, filt_list)
+            else:
+                saved += display_two_tramways(self.display, filt_list)
+        REFRESH_DURATION.observe(time.perf_counter() - start)
+        self.logger.debug('Refresh saved %d I2C transactions.', saved)
+        for listener in self.listeners:
+            listener()
+        return True
+
+    def collect_metrics(self):
+        """Mesures lues à la demande, sans coût sur le chemin d'envoi."""
+        if self.shown is not None:
+            yield SHOWN_AGE.name, self.labels, time.time() - self.shown
+        yield (I2C_TRANSACTIONS.name, self.labels,
+                self.display.transport.transactions)
+        yield I2C_BYTES.name, self.labels, self.display.bytes_sent
+        yield I2C_SAVED.name, self.labels, self.display.saved_total
@@ -0,0 +1,225 @@
+"""
+In-memory HD44780 behind a PCF8574 I2C expander.
+
+EmulatedLCD can be given to LiquidCrystalI2C in place of an smbus.SMBus.
+It decodes the pin states written to the expander into controller
+instructions and data, keeps DDRAM/CGRAM and the controller state, and
+counts transactions, bytes and the time they would take on the bus, so
+rendering can be checked and measured without hardware.
+
+Example:
+    lcd = LiquidCrystalI2C(bus=EmulatedLCD())
+    lcd.display_string('Hello', 1)
+    print(lcd.bus.render())
+"""
+
+import sys
+
+from rpi_i2c_lcd import (CLEARDISPLAY, RETURNHOME, ENTRYMODESET,
+        DISPLAYCONTROL, CURSORSHIFT, FUNCTIONSET, SETCGRAMADDR, SETDDRAMADDR,
+        ENTRYINC, ENTRYMOVEOFF, DISPLAYON, CURSORON, BLINKON, DISPLAYMOVE,
+        MOVERIGHT, MODE8BIT, MODE2LINE, BACKLIGHT, EN, RS, DDRAM_SIZE,
+        LINE_LENGTH, LINE_OFFSETS, next_ddram_addr)
+
+BUS_FREQUENCY = 100000      # standard mode I2C, bits per second
+BITS_PER_BYTE = 9           # 8 data bits and acknowledge
+START_STOP_BITS = 2
+
+# Characters of the A00 ROM differing from ASCII
+ROM_CHARS = {0x5C: '¥', 0x7E: '→', 0x7F: '←', 0xDF: '°'}
+# Custom characters 0 to 7 rendered as circled digits
+CUSTOM_CHARS = '⓪①②③④⑤⑥⑦'
+
+
+class EmulatedLCD:
+    """smbus compatible bus holding an emulated 16x2 (or 20x4) display.
+
+    Attributes:
+        ddram: display data RAM, 0x80 bytes
+        cgram: character generator RAM, 8 glyphs of 8 lines
+        address: address counter
+        in_ddram: whether the address counter points to DDRAM
+        eight_bit: interface in 8 bits mode (state at power on)
+        increment: entry mode, address incremented after a write
+        shift_on_write: entry mode, display shifted after a write
+        display_on, cursor_on, blink_on: display control flags
+        two_lines: function set N flag
+        shift: number of left shifts of the display (modulo 40)
+        backlight: state of the backlight pin
+        transactions: number of I2C transactions
+        bytes_sent: number of bytes written, address bytes excluded
+        bus_time: seconds the transactions would take on the bus
+        echo: stream the screen is printed to when it changes, or None
+    """
+
+    def __init__(self, rows=2, cols=16, echo=None):
+        self.rows = rows
+        self.cols = cols
+        self.echo = echo
+        self.ddram = bytearray(b' ' * DDRAM_SIZE)
+        self.cgram = bytearray(64)
+        self.address = 0
+        self.in_ddram = True
+        self.eight_bit = True
+        self.increment = True
+        self.shift_on_write = False
+        self.display_on = False
+        self.cursor_on = False
+        self.blink_on = False
+        self.two_lines = False
+        self.shift = 0
+        self.backlight = False
+        self.transactions = 0
+        self.bytes_sent = 0
+        self.bus_time = 0.0
+        self._pins = 0
+        self._high_nibble = None
+        self._echoed = None
+
+    # smbus interface
+
+    def write_byte(self, addr, value):
+        self._transaction([value])
+
+    def write_i2c_block_data(self, addr, cmd, values):
+        self._transaction([cmd] + list(values))
+
+    def close(self):
+        pass
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes_sent = 0
+        self.bus_time = 0.0
+
+    # PCF8574
+
+    def _transaction(self, data):
+        self.transactions += 1
+        self.bytes_sent += len(data)
+        self.bus_time += ((len(data) + 1) * BITS_PER_BYTE
+                + START_STOP_BITS) / BUS_FREQUENCY
+        for value in data:
+            self._set_pins(value)
+        if self.echo is not None:
+            screen = self.render()
+            if screen != self._echoed:
+                self._echoed = screen
+                self.echo.write(screen + '\n\n')
+
+    def _set_pins(self, value):
+        self.backlight = bool(value & BACKLIGHT)
+        # The controller latches D4-D7 on the falling edge of EN.
+        if self._pins & EN and not value & EN:
+            self._latch(value & 0xF0, bool(value & RS))
+        self._pins = value
+
+    def _latch(self, nibble, rs):
+        if self.eight_bit:
+            # Only D4-D7 are wired, D0-D3 read as 0.
+            self._execute(nibble, rs)
+        elif self._high_nibble is None:
+            self._high_nibble = nibble
+        else:
+            value = self._high_nibble | (nibble >> 4)
+            self._high_nibble = None
+            self._execute(value, rs)
+
+    # HD44780
+
+    def _execute(self, value, rs):
+        if rs:
+            self._write_data(value)
+        elif value & SETDDRAMADDR:
+            self.address = value & 0x7F
+            self.in_ddram = True
+        elif value & SETCGRAMADDR:
+            self.address = value & 0x3F
+            self.in_ddram = False
+        elif value & FUNCTIONSET:
+            self.eight_bit = bool(value & MODE8BIT)
+            self.two_lines = bool(value & MODE2LINE)
+            self._high_nibble = None
+        elif value & CURSORSHIFT:
+            right = bool(value & MOVERIGHT)
+            if value & DISPLAYMOVE:
+                self.shift = (self.shift + (-1 if right else 1)) % LINE_LENGTH
+            elif self.in_ddram:
+                self.address = next_ddram_addr(self.address, right)
+        elif value & DISPLAYCONTROL:
+            self.display_on = bool(value & DISPLAYON)
+            self.cursor_on = bool(value & CURSORON)
+            self.blink_on = bool(value & BLINKON)
+        elif value & ENTRYMODESET:
+            self.increment = bool(value & ENTRYINC)
+            self.shift_on_write = bool(value & ENTRYMOVEOFF)
+        elif value & RETURNHOME:
+            self.address = 0
+            self.in_ddram = True
+            self.shift = 0
+        elif value & CLEARDISPLAY:
+            self.ddram[:] = b' ' * DDRAM_SIZE
+            self.address = 0
+            self.in_ddram = True
+            self.shift = 0
+            self.increment = True
+
+    def _write_data(self, value):
+        if not self.in_ddram:
+            self.cgram[self.address] = value & 0x1F
+            self.address = (self.address + (1 if self.increment else -1)) & 0x3F
+            return
+        self.ddram[self.address] = value
+        self.address = next_ddram_addr(self.address, self.increment)
+        if self.shift_on_write:
+            self.shift = (self.shift + (1 if self.increment else -1)) \
+                    % LINE_LENGTH
+
+    # Rendering
+
+    def cell(self, row, col):
+        """DDRAM address shown at row, col given the display shift."""
+        base = LINE_OFFSETS[row] & 0x40
+        offset = LINE_OFFSETS[row] - base
+        return base + (offset + col + self.shift) % LINE_LENGTH
+
+    def char(self, code):
+        """Text representation of a character code."""
+        if code < 0x10:
+            return CUSTOM_CHARS[code & 0x07]
+        if code in ROM_CHARS:
+            return ROM_CHARS[code]
+        if 0x20 <= code < 0x80:
+            return chr(code)
+        return '?'
+
+    def lines(self):
+        """Visible text, one string per row."""
+        if not self.display_on:
+            return [' ' * self.cols] * self.rows
+        return [''.join(self.char(self.ddram[self.cell(row, col)])
+                for col in range(self.cols)) for row in range(self.rows)]
+
+    def render(self):
+        """Visible text framed, backlight state shown by the frame."""
+        edge = '#' if self.backlight else '.'
+        border = edge * (self.cols + 2)
+        return '\n'.join([border] + [edge + line + edge
+            for line in self.lines()] + [border])
+
+    def glyph(self, code):
+        """Custom character as 8 lines of '#' and '.'."""
+        start = (code & 0x07) * 8
+        return ['{:05b}'.format(line).replace('1', '#').replace('0', '.')
+                for line in self.cgram[start:start + 8]]
+
+
+def main():
+    from rpi_i2c_lcd import LiquidCrystalI2C
+    lcd = LiquidCrystalI2C(bus=EmulatedLCD(echo=sys.stdout))
+    lcd.display_string(' '.join(sys.argv[1:]) or 'Hello world', 1)
+    lcd.bus.echo = None
+
+
+if __name__ == '__main__':
+    main()
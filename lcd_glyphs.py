@@ -0,0 +1,80 @@
+"""
+CGRAM glyph cache for custom characters.
+
+The HD44780 holds 8 custom characters (codes 0 to 7). GlyphCache keeps
+track of what each slot holds so a glyph is only uploaded when it is not
+already resident, and hands out slots with least recently used eviction
+so more than 8 glyphs can be used overall.
+"""
+
+from collections import OrderedDict
+
+CGRAM_SLOTS = 8
+
+
+class GlyphCache:
+    """Custom characters slots of a LiquidCrystalI2C.
+
+    Attributes:
+        display: LiquidCrystalI2C
+        slots: glyph held by each slot, None if unknown
+        uploads: number of glyphs written to CGRAM
+        hits: number of glyphs found already resident
+    """
+
+    def __init__(self, display, size=CGRAM_SLOTS):
+        self.display = display
+        self.slots = [None] * size
+        # Least recently used slot first
+        self._lru = OrderedDict.fromkeys(range(size))
+        self.uploads = 0
+        self.hits = 0
+
+    def load(self, slot, glyph):
+        """Put glyph in a given slot, unless already there."""
+        glyph = tuple(glyph)
+        if self.slots[slot] == glyph:
+            self.hits += 1
+        else:
+            self._upload(slot, glyph)
+        self._lru.move_to_end(slot)
+        return slot
+
+    def slot_for(self, glyph):
+        """Return the slot holding glyph, uploading it if needed.
+
+        The least recently used slot is evicted. Cells already showing
+        the evicted glyph will change on screen. Animations place their
+        own glyphs when compiled and report them with assume.
+        """
+        glyph = tuple(glyph)
+        try:
+            slot = self.slots.index(glyph)
+        except ValueError:
+            slot = next(iter(self._lru))
+            self._upload(slot, glyph)
+        else:
+            self.hits += 1
+        self._lru.move_to_end(slot)
+        return slot
+
+    def assume(self, slot, glyph):
+        """Record glyph as written to slot by someone else."""
+        self.slots[slot] = tuple(glyph)
+        self._lru.move_to_end(slot)
+
+    def invalidate(self, slots=None):
+        """Forget the content of slots (all of them by default)."""
+        for slot in range(len(self.slots)) if slots is None else slots:
+            self.slots[slot] = None
+
+    def _upload(self, slot, glyph):
+        # CGRAM must be written with an incrementing address counter.
+        restore = not self.display.curs_inc
+        if restore:
+            self.display.entry_mode_set(cursor_inc=True)
+        self.display.load_single_custom_char(slot, glyph)
+        if restore:
+            self.display.entry_mode_set(cursor_inc=False)
+        self.slots[slot] = glyph
+        self.uploads += 1
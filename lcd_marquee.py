@@ -0,0 +1,109 @@
+"""
+Défilement des arrivées sur écran lcd 16x2.
+
+Toutes les arrivées à venir défilent avec leur destination : la ligne
+du haut porte la destination, celle du bas la ligne et les minutes
+restantes, chaque station étant précédée de son nom et de l'heure.
+
+Le défilement utilise le décalage de l'écran par le contrôleur : chaque
+ligne de la DDRAM compte 40 cellules dont seules 16 sont visibles. Le
+texte est écrit dans ces 40 cellules et un pas ne coûte qu'une commande
+de décalage, plus l'écriture des cellules masquées dont le contenu doit
+changer avant de réapparaître (texte plus long que 40 caractères,
+minutes écoulées).
+
+Sur un écran 4 lignes, les lignes 1 et 3 (2 et 4) partagent la même
+ligne de DDRAM et défileraient ensemble : le décalage n'y est pas
+utilisé.
+"""
+
+import time
+
+from rpi_i2c_lcd import LINE_LENGTH
+
+MARQUEE_STEP_TIME = 0.4     # Un pas de défilement toutes les 0,4 secondes
+MAX_DESTINATION = 20        # Destinations tronquées à 20 caractères
+SEPARATOR = '  '            # Entre deux blocs du texte défilant
+
+
+def marquee_rows(shown, now):
+    """Les deux lignes du texte défilant.
+
+    Arguments:
+        shown: couples (nom de station, tuples (ligne, minutes
+            restantes, destination, séparateur des minutes))
+        now: datetime, heure affichée après chaque nom de station
+    """
+    top, bottom = [], []
+    for station, arrivals in shown:
+        blocks = [(station, '{:%H:%M}'.format(now))]
+        blocks += [(destination[:MAX_DESTINATION],
+                    '{}{}{:3}m'.format(line, mark, minutes))
+                   for line, minutes, destination, mark in arrivals]
+        for upper, lower in blocks:
+            width = max(len(upper), len(lower)) + len(SEPARATOR)
+            top.append(upper.ljust(width))
+            bottom.append(lower.ljust(width))
+    return ''.join(top), ''.join(bottom)
+
+
+class Marquee:
+    """Texte défilant sur les deux lignes d'un LiquidCrystalI2C.
+
+    La position du défilement dépend de l'heure et non du nombre
+    d'appels : un réveil en retard rattrape les pas manqués.
+
+    Attributs:
+        display: LiquidCrystalI2C
+        cols: largeur de l'écran
+        scrolling: le dernier texte affiché défile
+    """
+
+    def __init__(self, display, cols=16):
+        self.display = display
+        self.cols = cols
+        self.scrolling = False
+
+    def draw(self, rows):
+        """Affiche rows (deux chaînes) à la position courante.
+
+        Renvoie le nb d'octets épargnés par rapport à une réécriture des
+        deux lignes.
+        """
+        length = max(len(row) for row in rows)
+        self.scrolling = length > self.cols
+        if not self.scrolling:
+            rows = [row.ljust(self.cols) for row in rows]
+            step = 0
+        else:
+            # Une période de 40 fige le contenu de chaque cellule.
+            length = max(length, LINE_LENGTH)
+            rows = [row.ljust(length) for row in rows]
+            step = int(time.monotonic() // MARQUEE_STEP_TIME)
+
+        shift = step % LINE_LENGTH
+        saved = 0
+        with self.display.batch():
+            for line, row in enumerate(rows, 1):
+                if not self.scrolling:
+                    cells = row
+                else:
+                    # Cellule col : position du texte qu'elle montrera
+                    # lorsque l'écran sera décalé de shift.
+                    cells = ''.join(row[(step + (col - shift) % LINE_LENGTH)
+                        % length] for col in range(LINE_LENGTH))
+                saved += self.display.display_string(cells, line)
+            self.display.shift_display_to(shift)
+        return saved
+
+    def reset(self):
+        """Ramène l'écran sans décalage, pour un affichage fixe."""
+        self.scrolling = False
+        if self.display.shift:
+            self.display.return_home()
+
+    def next_step(self):
+        """Secondes avant le prochain pas, None sans défilement."""
+        if not self.scrolling:
+            return None
+        return MARQUEE_STEP_TIME - time.monotonic() % MARQUEE_STEP_TIME
@@ -0,0 +1,177 @@
+"""
+LCD driven from a separate process through shared memory.
+
+FramebufferLCD is given to LiquidCrystalI2C in place of an smbus.SMBus:
+the main process renders into an emulated controller (lcd_emulator) and
+publishes its DDRAM, CGRAM, display shift and on/off flags to a shared
+memory segment. A driver process copies each new frame to the real
+display with its own LiquidCrystalI2C, so only the cells and glyphs that
+changed are sent, and the I2C timing no longer depends on the GIL or on
+the garbage collection of the fetching threads.
+
+The segment is a sequence lock: the writer makes the counter odd while
+it writes a frame and even afterwards, the reader retries until it
+copied a frame with the same even counter before and after. Frames
+with the counter already applied are skipped. A frame is published when
+LiquidCrystalI2C has sent a whole batch, never in the middle of one.
+
+Each driver process opens the I2C bus itself: the kernel still
+serializes the transactions of several displays on one bus, but not in
+turn as SharedBus does between threads, so an animation on one display
+can delay the others by more than one block.
+"""
+
+import atexit
+import multiprocessing
+import os
+import signal
+import struct
+import time
+
+from lcd_emulator import EmulatedLCD
+from rpi_i2c_lcd import (LiquidCrystalI2C, DEVICE_ADDR, DEVICE_BUS,
+        LINE_LENGTH)
+
+SEQUENCE = struct.Struct('<I')
+# DDRAM, CGRAM, display shift, display on, backlight
+FRAME = struct.Struct('<128s64sB??')
+PARENT_CHECK = 1.0          # seconds between checks the main process is alive
+STOP_TIMEOUT = 2.0          # seconds given to the driver to show the last frame
+
+# spawn: the driver does not inherit the locks held by the other threads.
+_context = multiprocessing.get_context('spawn')
+
+
+def read_frame(memory):
+    """Sequence number and fields of the last complete frame in memory."""
+    while True:
+        before, = SEQUENCE.unpack_from(memory)
+        if not before % 2:
+            frame = FRAME.unpack_from(memory, SEQUENCE.size)
+            after, = SEQUENCE.unpack_from(memory)
+            if after == before:
+                return before, frame
+        # The writer is in the middle of a frame.
+        time.sleep(0)
+
+
+class FrameApplier:
+    """Copy frames to a LiquidCrystalI2C, sending only what changed.
+
+    Attributes:
+        lcd: LiquidCrystalI2C driving the real display
+        cgram: glyphs already uploaded, None before the first frame
+        display_on, backlight: flags already applied
+    """
+
+    def __init__(self, lcd):
+        self.lcd = lcd
+        self.cgram = None
+        self.display_on = True
+        self.backlight = True
+
+    def apply(self, frame):
+        ddram, cgram, shift, display_on, backlight = frame
+        lcd = self.lcd
+        with lcd.batch():
+            for slot in range(len(cgram) // 8):
+                glyph = cgram[slot * 8:slot * 8 + 8]
+                if self.cgram is None or glyph != self.cgram[slot * 8:
+                        slot * 8 + 8]:
+                    lcd.load_single_custom_char(slot, glyph)
+            self.cgram = cgram
+            # Both 40 cells lines of DDRAM, rows 3 and 4 included.
+            for line, start in ((1, 0x00), (2, 0x40)):
+                lcd.display_string(ddram[start:start + LINE_LENGTH]
+                        .decode('latin-1'), line)
+            lcd.shift_display_to(shift)
+            if display_on != self.display_on:
+                lcd.display_control(display=display_on)
+                self.display_on = display_on
+            if backlight != self.backlight:
+                lcd.backlight(backlight)
+                self.backlight = backlight
+
+
+def drive(memory, changed, stop, parent, addr, port, batched, bus):
+    """Driver process: apply each new frame until stop is set or the main
+    process is gone, then the last one."""
+    # Stopped by the main process, after its last frame.
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_IGN)
+    applier = FrameApplier(LiquidCrystalI2C(addr, port, batched, bus))
+    applied = None
+    while True:
+        stopping = stop.is_set() or os.getppid() != parent
+        changed.clear()
+        sequence, frame = read_frame(memory)
+        if sequence != applied:
+            applier.apply(frame)
+            applied = sequence
+        if stopping:
+            break
+        changed.wait(timeout=PARENT_CHECK)
+
+
+class FramebufferLCD(EmulatedLCD):
+    """smbus compatible bus publishing the emulated display to a driver
+    process.
+
+    Attributes:
+        memory: shared sequence counter and frame
+        sequence: counter of the last frame published
+        published: last frame published, packed
+        changed: event set after each new frame
+        stop: event asking the driver to stop
+        process: driver process
+    """
+
+    def __init__(self, addr=DEVICE_ADDR, port=DEVICE_BUS, batched=True,
+            rows=2, cols=16, bus=None):
+        """addr, port, batched: display driven by the process, as for
+        LiquidCrystalI2C.
+        bus: picklable smbus compatible object used by the process instead
+        of port (ex: EmulatedLCD)."""
+        super().__init__(rows, cols)
+        self.memory = _context.RawArray('B', SEQUENCE.size + FRAME.size)
+        self._view = memoryview(self.memory).cast('B')
+        self.sequence = 0
+        self.published = None
+        self.changed = _context.Event()
+        self.stop = _context.Event()
+        self.process = _context.Process(target=drive, args=(self.memory,
+            self.changed, self.stop, os.getpid(), addr, port, batched, bus),
+            name='lcd-{:#x}'.format(addr), daemon=True)
+        self.process.start()
+        # Before multiprocessing terminates its daemon processes at exit.
+        atexit.register(self.close)
+
+    def publish(self):
+        """Publish the current state, if it changed."""
+        frame = FRAME.pack(bytes(self.ddram), bytes(self.cgram), self.shift,
+                self.display_on, self.backlight)
+        if frame == self.published or self.stop.is_set():
+            return
+        if not self.process.is_alive():
+            raise OSError('LCD driver process exited with code {}.'.format(
+                self.process.exitcode))
+        SEQUENCE.pack_into(self.memory, 0, self.sequence + 1)
+        self._view[SEQUENCE.size:] = frame
+        self.sequence += 2
+        SEQUENCE.pack_into(self.memory, 0, self.sequence)
+        self.published = frame
+        self.changed.set()
+
+    def end_frame(self):
+        """Called by LiquidCrystalI2C once a batch is sent: the frame is
+        complete."""
+        self.publish()
+
+    def close(self):
+        """Stop the driver once it has shown the last frame, its display
+        being cleared when it exits."""
+        self.stop.set()
+        self.changed.set()
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
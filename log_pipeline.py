@@ -0,0 +1,146 @@
+"""
+Journalisation sans attente pour les threads.
+
+Les threads ne font que déposer leurs messages dans une file, un thread
+dédié les écrit dans un fichier limité en taille (rotation). Les
+écritures sur carte SD, parfois lentes, ne retardent ainsi ni les
+requêtes ni l'affichage.
+
+Les messages répétés sont regroupés en une ligne indiquant leur nombre :
+messages identiques, ou avertissements et erreurs de même origine et de
+même modèle (par exemple les erreurs de connexion pendant une coupure,
+dont seuls le nb de tentatives et le délai varient).
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import time
+
+LOG_FORMAT = '[%(asctime)s]%(levelname)s:%(name)s:%(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+LOG_MAX_BYTES = 512 * 1024  # Taille d'un fichier de log avant rotation
+LOG_BACKUPS = 3             # Nb d'anciens fichiers conservés
+QUEUE_SIZE = 1000           # Messages en attente d'écriture au maximum
+REPEAT_SUMMARY = 10 * 60    # Bilan des répétitions au moins toutes les 10 min
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Dépôt des messages dans une file, sans jamais attendre.
+
+    Si la file est pleine le message est abandonné, leur nombre étant
+    signalé au dépôt suivant.
+
+    Attributs:
+        dropped: nb de messages abandonnés depuis le dernier signalement
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Même processus : le message est mis en forme par l'écrivain,
+        # son modèle restant disponible pour le regroupement.
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': '%d log messages dropped.',
+                    'args': (self.dropped,)}))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class CollapsingHandler(logging.Handler):
+    """Regroupement des messages répétés avant leur écriture par target.
+
+    Le premier message d'une série est écrit, les suivants sont comptés
+    et résumés par une ligne à la fin de la série, ou toutes les
+    REPEAT_SUMMARY secondes si elle dure.
+
+    Attributs:
+        target: Handler écrivant les messages
+        last: dernier message écrit ou compté
+        repeats: nb de répétitions non encore résumées
+        since: début des répétitions non résumées (time.monotonic)
+    """
+
+    def __init__(self, target):
+        super().__init__()
+        self.target = target
+        self.last = None
+        self.repeats = 0
+        self.since = None
+
+    @staticmethod
+    def _key(record):
+        if record.levelno >= logging.WARNING:
+            return record.name, record.levelno, record.msg
+        return record.name, record.levelno, record.getMessage()
+
+    def _summarize(self):
+        if not self.repeats:
+            return
+        last = self.last
+        summary = logging.makeLogRecord(dict(last.__dict__,
+            msg='Last message repeated %d times (last: %s)',
+            args=(self.repeats, last.getMessage()), exc_info=None,
+            exc_text=None))
+        self.repeats = 0
+        self.target.handle(summary)
+
+    def emit(self, record):
+        if self.last is not None and self._key(record) == \
+                self._key(self.last):
+            if not self.repeats:
+                self.since = time.monotonic()
+            self.repeats += 1
+            self.last = record
+            if time.monotonic() - self.since >= REPEAT_SUMMARY:
+                self._summarize()
+            return
+        self._summarize()
+        self.last = record
+        self.target.handle(record)
+
+    def flush(self):
+        self.target.flush()
+
+    def close(self):
+        self.acquire()
+        try:
+            self._summarize()
+            self.target.close()
+        finally:
+            self.release()
+        super().close()
+
+
+def setup(filename, level=logging.INFO, max_bytes=LOG_MAX_BYTES,
+        backups=LOG_BACKUPS):
+    """Journalisation de tous les loggers dans filename via une file.
+
+    Renvoie le QueueListener écrivant les messages, arrêté à la sortie
+    du script (atexit) après l'écriture des messages en attente.
+    """
+    target = logging.handlers.RotatingFileHandler(filename,
+            maxBytes=max_bytes, backupCount=backups)
+    target.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
+    records = queue.Queue(QUEUE_SIZE)
+    listener = logging.handlers.QueueListener(records,
+            CollapsingHandler(target))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(DroppingQueueHandler(records))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
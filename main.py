@@ -1,21 +1,33 @@
 #! /usr/bin/env python3
 
+import time
+STARTED = time.perf_counter()   # Avant les imports, pour --profile-startup
+
+from datetime import datetime
 import sys
 import threading
 import signal
 import argparse
 import logging
-import infos_tram
+import log_pipeline
 import shared_data
 import lcd_display
+import metrics
+import poll_scheduler
+import siri_cache
+# La pile HTTP (requests, http.server) n'est importée qu'une fois l'écran
+# initialisé : infos_tram, arrivals_proxy, siri_replay, metrics_server,
+# de même que arrival_model et arrival_history.
 
 TOKEN = ''
 STATION_REF = ''
 I2C_ADDR = 0x3f
 I2C_BUS = 1
 LOGS = sys.argv[0] + '.log'
+CACHE = sys.argv[0] + '.cache'
 
 stop_event = threading.Event()
+displays = []
 
 
 def int16(string):
@@ -23,45 +35,251 @@ def int16(string):
     return int(string, 16)
 
 
+def positive_int(string):
+    """Conversion de type pour parser : entier strictement positif."""
+    value = int(string)
+    if value <= 0:
+        raise ValueError(string)
+    return value
+
+
 def sig_handler(signum, frame):
     stop_event.set()
+    for display in displays:
+        display.notify()
+
+
+def lcd_spec(string):
+    """Conversion de type pour parser :
+    adresse[:bus[:station,...[:ligne,...]]]."""
+    fields = string.split(':')
+    if len(fields) > 4:
+        raise ValueError(string)
+    addr = int16(fields[0])
+    bus = int(fields[1]) if len(fields) > 1 and fields[1] else None
+    stations = fields[2].split(',') if len(fields) > 2 and fields[2] else None
+    lines = fields[3].split(',') if len(fields) > 3 and fields[3] else None
+    return addr, bus, stations, lines
+
+
+def time_window(string):
+    """Conversion de type pour parser : HH:MM-HH:MM."""
+    start, end = string.split('-')
+    return (datetime.strptime(start, '%H:%M').time(),
+            datetime.strptime(end, '%H:%M').time())
+
+
+def address(string):
+    """Conversion de type pour parser : [hôte:]port."""
+    host, _, port = string.rpartition(':')
+    return host or '127.0.0.1', int(port)
 
 
 def main():
     parser = argparse.ArgumentParser(
             description='Tram station monitoring on I2C LCD.')
-    parser.add_argument('--station', help='station reference (ex: 275A)',
-            required=True)
-    parser.add_argument('token', help='authentification token')
+    parser.add_argument('--station', action='append', default=[],
+            help='station reference (ex: 275A), repeat for several stations')
+    parser.add_argument('token', nargs='?',
+            help='authentification token (not needed with --proxy)')
     parser.add_argument('-i', dest='i2c', type=int16, default=I2C_ADDR,
             help='I2C module address (in hexadecimal)')
     parser.add_argument('-b', dest='bus', type=int, default=I2C_BUS,
             help='I2C bus (0 -- original Pi, 1 -- above versions)')
+    parser.add_argument('--lcd', action='append', type=lcd_spec, default=[],
+            metavar='ADDR[:BUS[:STATION,...[:LINE,...]]]',
+            help='drive a display at ADDR (hexadecimal) on BUS (-b by '
+                'default) showing the given stations (all by default) and '
+                'lines (all by default), repeat for several displays; '
+                'replaces -i')
+    parser.add_argument('--size', choices=('16x2', '20x4'), default='16x2',
+            help='display size, columns x rows')
+    parser.add_argument('--marquee', action='store_true',
+            help='scroll every upcoming arrival with its destination '
+                '(pages of three arrivals on 20x4 displays)')
+    parser.add_argument('--idle-hours', action='append', type=time_window,
+            default=[], metavar='HH:MM-HH:MM',
+            help='hours when the animation may play without arrivals, '
+                'repeat for several windows (all day by default)')
+    parser.add_argument('--idle-animation', type=float,
+            default=lcd_display.IDLE_ANIMATION / 60, metavar='MINUTES',
+            help='longest animation without arrivals before the display '
+                'goes to sleep with its backlight off (%(default)g by '
+                'default, 0 to sleep at once)')
+    parser.add_argument('--idle-blank', action='store_true',
+            help='also turn the display off while asleep')
+    parser.add_argument('--per-byte', dest='batched', action='store_false',
+            help='send I2C bytes one by one (slow, for marginal hardware)')
+    parser.add_argument('--lcd-process', action='store_true',
+            help='drive the LCDs from separate processes fed through shared '
+                'memory, unaffected by the load of fetching')
+    parser.add_argument('--emulate', action='store_true',
+            help='drive an emulated LCD printed on standard output')
     parser.add_argument('-l', dest='log', default=LOGS,
             help='log specified location')
+    parser.add_argument('--budget', type=positive_int,
+            default=poll_scheduler.REQUESTS_PER_HOUR,
+            help='maximum number of API requests per hour')
+    parser.add_argument('--url',
+            help='stop-monitoring service (ex: a local siri_replay.py), '
+                'the CTS API by default')
+    parser.add_argument('--serve', metavar='[HOST:]PORT', type=address,
+            help='share the arrivals with other displays (see --proxy)')
+    parser.add_argument('--proxy', metavar='URL',
+            help='get the arrivals from a main.py started with --serve')
+    parser.add_argument('--no-display', dest='display', action='store_false',
+            help='only fetch and serve the arrivals (with --serve)')
+    parser.add_argument('--record', metavar='FILE',
+            help='append every response received to FILE')
+    parser.add_argument('--no-estimate', dest='estimate',
+            action='store_false',
+            help='do not extend the announced arrivals with arrivals '
+                'estimated from the headways of recent responses (shown '
+                'with ~)')
+    parser.add_argument('--history', metavar='FILE',
+            help='keep every predicted arrival in FILE, a fixed-size ring '
+                '(see arrival_history.py)')
+    parser.add_argument('--history-size', type=int, metavar='RECORDS',
+            help='records kept by a new --history file (80 bytes each, '
+                '200000 by default)')
+    parser.add_argument('--cache', default=CACHE,
+            help='file keeping the last response, shown at startup')
+    parser.add_argument('--no-cache', dest='cache', action='store_const',
+            const=None, help='do not keep the last response')
+    parser.add_argument('--runtime', choices=('threads', 'asyncio'),
+            default='threads',
+            help='run fetcher and display as threads or in an asyncio loop')
+    parser.add_argument('--metrics-port', type=int,
+            help='serve Prometheus metrics on localhost:PORT/metrics')
+    parser.add_argument('--metrics-file', metavar='FILE',
+            help='write Prometheus metrics to FILE every minute')
+    parser.add_argument('--profile-startup', action='store_true',
+            help='print the time spent in each startup step until the '
+                'first arrivals are shown')
+    parser.add_argument('-v', dest='verbose', action='store_true',
+            help='log debug messages (request timings, I2C savings)')
 
     args = parser.parse_args()
+    if not args.token and not args.proxy:
+        parser.error('a token is required unless --proxy is given')
+    # Stations de --station puis celles des écrans, sans doublon.
+    stations = list(dict.fromkeys(args.station + [ref
+        for _, _, refs, _ in args.lcd for ref in refs or ()]))
+    if not stations:
+        parser.error('at least one station is required')
+    if args.lcd_process and args.emulate:
+        parser.error('--lcd-process drives real LCDs, not --emulate')
+    if args.history and args.proxy:
+        parser.error('--history needs the arrivals from the API, not --proxy')
+
+    # Écriture du log par un thread dédié, arrêté à la sortie.
+    log_pipeline.setup(args.log,
+            logging.DEBUG if args.verbose else logging.INFO)
+    profile = None
+    if args.profile_startup:
+        import startup_profile
+        profile = startup_profile.StartupProfile(STARTED)
 
-    logging.basicConfig(filename=args.log, level=logging.INFO,
-            format='[%(asctime)s]%(levelname)s:%(name)s:%(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S')
-    shared_list = shared_data.SharedList()
-    infos = infos_tram.InfosThr(shared_list, stop_event, args.station,
-            args.token)
-    display = lcd_display.DisplayThr(shared_list, stop_event, args.i2c, args.bus)
+    # Écran d'abord : attente ou dernières arrivées connues, avant même
+    # d'importer la pile HTTP.
+    channels = {ref: shared_data.SnapshotChannel() for ref in stations}
+    if args.display:
+        cols, rows = map(int, args.size.split('x'))
+        for addr, i2c_bus, refs, lines in args.lcd or [(args.i2c, None,
+                None, None)]:
+            bus = None
+            i2c_bus = args.bus if i2c_bus is None else i2c_bus
+            if args.emulate:
+                import lcd_emulator
+                bus = lcd_emulator.EmulatedLCD(rows, cols, sys.stdout)
+            elif args.lcd_process:
+                import lcd_process
+                bus = lcd_process.FramebufferLCD(addr, i2c_bus, args.batched,
+                        rows, cols)
+            display = lcd_display.DisplayThr(
+                    [channels[ref] for ref in refs or channels], stop_event,
+                    addr, i2c_bus, args.batched, bus, lines, rows, cols,
+                    args.marquee, lcd_display.IdlePolicy(args.idle_hours,
+                        args.idle_animation * 60, args.idle_blank))
+            if profile:
+                display.listeners.append(profile.first_frame)
+            displays.append(display)
+        if profile:
+            profile.mark('lcd init')
+        for display in displays:
+            display.splash()
+        if profile:
+            profile.mark('splash')
 
-    signal.signal(signal.SIGINT, sig_handler)
-    signal.signal(signal.SIGTERM, sig_handler)
-    signal.signal(signal.SIGHUP, sig_handler)
+    cache = None
+    if args.cache and not args.proxy:
+        cache = siri_cache.ResponseCache(args.cache)
+        cache.restore(channels)
+        for display in displays:
+            # Sans arrivée à venir, l'écran d'attente reste affiché.
+            display.refresh()
+        if profile:
+            profile.mark('cached data')
+
+    if args.proxy:
+        import arrivals_proxy
+        infos = arrivals_proxy.ProxyInfosThr(channels, stop_event,
+                list(channels), args.proxy)
+    else:
+        import infos_tram
+        recorder = None
+        if args.record:
+            import siri_replay
+            recorder = siri_replay.ResponseRecorder(args.record)
+        history = None
+        if args.history:
+            import arrival_history
+            history = arrival_history.ArrivalHistory(args.history,
+                    args.history_size or arrival_history.HISTORY_RECORDS)
+        model = None
+        if args.estimate:
+            import arrival_model
+            model = arrival_model.HeadwayModel()
+        infos = infos_tram.InfosThr(channels, stop_event, list(channels),
+                args.token, poll_scheduler.RequestBudget(args.budget),
+                args.url or infos_tram.URL, recorder, cache, history, model)
+    if profile:
+        profile.mark('http stack import, fetcher')
+    if args.serve:
+        import arrivals_proxy
+        arrivals_proxy.ProxyServer(args.serve, channels, infos).start()
+
+    if args.metrics_port:
+        import metrics_server
+        metrics_server.MetricsServer(('127.0.0.1', args.metrics_port)).start()
+    if args.metrics_file:
+        dumper = metrics.MetricsDumper(args.metrics_file, stop_event)
+        dumper.start()
 
     logging.info('Server start.')
-    infos.start()
-    display.start()
+    if args.runtime == 'asyncio':
+        import asyncio
+        import async_runtime
+        asyncio.run(async_runtime.run([infos], displays, stop_event))
+    else:
+        for display in displays:
+            infos.listeners.append(display.notify)
+        signal.signal(signal.SIGINT, sig_handler)
+        signal.signal(signal.SIGTERM, sig_handler)
+        signal.signal(signal.SIGHUP, sig_handler)
+
+        infos.start()
+        for display in displays:
+            display.start()
 
-    infos.join()
-    display.join()
+        infos.join()
+        for display in displays:
+            display.join()
+    if args.metrics_file:
+        dumper.join()
+    if args.history:
+        history.close()
     logging.info('Server shutdown.')
-    logging.shutdown()
 
     sys.exit(0)
 
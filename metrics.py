@@ -0,0 +1,257 @@
+"""
+Mesures de fonctionnement au format texte de Prometheus.
+
+Les compteurs et histogrammes sont incrémentés par les threads, les
+valeurs déjà tenues ailleurs (octets envoyés sur le bus I2C, âge des
+données, quota restant) sont lues par des collecteurs au moment de la
+lecture des mesures, sans rien coûter entre deux lectures.
+
+Les mesures sont servies en HTTP (metrics_server.MetricsServer, importé
+seulement s'il est utilisé) et/ou écrites régulièrement dans un fichier
+(MetricsDumper), par exemple pour le collecteur textfile de
+node_exporter :
+
+    ./main.py --metrics-port 9120 --metrics-file /var/lib/node/tram.prom ...
+    curl http://localhost:9120/metrics
+"""
+
+import bisect
+import logging
+import os
+import threading
+import weakref
+
+DUMP_INTERVAL = 60          # Écriture du fichier toutes les 60 secondes
+
+logger = logging.getLogger(__name__)
+
+
+def format_value(value):
+    """Valeur au format Prometheus."""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def format_labels(labels):
+    """Étiquettes ((nom, valeur), ...) au format Prometheus."""
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value)
+        .replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels) + '}'
+
+
+class Metric:
+    """Famille de mesures de même nom, une valeur par jeu d'étiquettes.
+
+    Attributs:
+        name: nom de la mesure
+        help: description
+        values: dict, valeur par tuple trié des étiquettes
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """Tuples (nom, étiquettes, valeur) des valeurs tenues."""
+        with self._lock:
+            return [(self.name, labels, value)
+                    for labels, value in self.values.items()]
+
+
+class Counter(Metric):
+    """Compteur, ne fait qu'augmenter."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Valeur instantanée."""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    """Répartition d'observations dans des intervalles cumulés.
+
+    Attributs:
+        buckets: bornes supérieures croissantes des intervalles
+        values: dict, [effectifs par intervalle, somme, nombre] par
+            tuple d'étiquettes
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1),
+                        0.0, 0]
+            counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for labels, (counts, total, number) in self.values.items():
+                cumulated = 0
+                for bound, count in zip(self.buckets + (float('inf'),),
+                        counts):
+                    cumulated += count
+                    samples.append((self.name + '_bucket',
+                        labels + (('le', format_value(float(bound))),),
+                        cumulated))
+                samples.append((self.name + '_sum', labels, total))
+                samples.append((self.name + '_count', labels, number))
+        return samples
+
+
+class Registry:
+    """Ensemble des mesures d'un processus.
+
+    Les collecteurs sont des fonctions sans argument renvoyant des tuples
+    (nom, étiquettes, valeur) pour des mesures déclarées dans le registre.
+    Un collecteur méthode n'empêche pas la destruction de son objet, il
+    est oublié avec lui.
+
+    Attributs:
+        metrics: dict, Metric par nom
+        collectors: références des collecteurs
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def _declare(self, cls, name, *args):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args)
+            elif not isinstance(metric, cls):
+                raise ValueError('{} already declared as {}.'.format(name,
+                    metric.kind))
+            return metric
+
+    def counter(self, name, help):
+        """Compteur name, créé à la première déclaration."""
+        return self._declare(Counter, name, help)
+
+    def gauge(self, name, help):
+        """Valeur instantanée name, créée à la première déclaration."""
+        return self._declare(Gauge, name, help)
+
+    def histogram(self, name, help, buckets):
+        """Histogramme name, créé à la première déclaration."""
+        return self._declare(Histogram, name, help, buckets)
+
+    def collector(self, function):
+        """Ajoute une fonction appelée à chaque lecture des mesures."""
+        if hasattr(function, '__self__'):
+            ref = weakref.WeakMethod(function)
+        else:
+            ref = lambda: function
+        with self._lock:
+            self.collectors.append(ref)
+
+    def collect(self):
+        """Échantillons des collecteurs, regroupés par nom de mesure."""
+        with self._lock:
+            self.collectors = [ref for ref in self.collectors
+                    if ref() is not None]
+            functions = [ref() for ref in self.collectors]
+        collected = {}
+        for function in functions:
+            if function is None:
+                continue
+            try:
+                for name, labels, value in function():
+                    collected.setdefault(name, []).append(
+                            (name, tuple(sorted(labels.items())), value))
+            except Exception:
+                logger.exception('Metrics collector %r failed.', function)
+        return collected
+
+    def render(self):
+        """Toutes les mesures au format texte de Prometheus."""
+        collected = self.collect()
+        lines = []
+        with self._lock:
+            metrics = sorted(self.metrics.items())
+        for name, metric in metrics:
+            samples = metric.samples() + collected.get(name, [])
+            if not samples:
+                continue
+            lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for sample, labels, value in samples:
+                lines.append('{}{} {}'.format(sample, format_labels(labels),
+                    format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """Écrit les mesures dans path, remplacé d'un seul coup."""
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as file:
+            file.write(self.render())
+        os.replace(tmp, path)
+
+
+REGISTRY = Registry()
+
+
+class MetricsDumper(threading.Thread):
+    """Thread écrivant régulièrement les mesures dans un fichier.
+
+    Attributs:
+        path: fichier écrit
+        stop_event: objet event pour signaler l'arrêt du script
+        interval: secondes entre deux écritures
+        registry: Registry écrit
+    """
+
+    def __init__(self, path, stop_event, interval=DUMP_INTERVAL,
+            registry=REGISTRY):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.stop_event = stop_event
+        self.interval = interval
+        self.registry = registry
+
+    def run(self):
+        while True:
+            stopping = self.stop_event.wait(timeout=self.interval)
+            try:
+                self.registry.dump(self.path)
+            except OSError:
+                logger.exception('Cannot write metrics to %s.', self.path,
+                        exc_info=False)
+            if stopping:
+                break
@@ -0,0 +1,48 @@
+"""
+Serveur HTTP des mesures au format texte de Prometheus.
+
+Séparé du module metrics pour ne charger la pile HTTP que si les mesures
+sont servies.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+from metrics import REGISTRY, logger
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        payload = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serveur HTTP des mesures (/metrics).
+
+    Attributs:
+        registry: Registry servi
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, registry=REGISTRY):
+        super().__init__(address, MetricsHandler)
+        self.registry = registry
+
+    def start(self):
+        """Sert les requêtes dans un thread daemon."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
@@ -0,0 +1,114 @@
+"""
+Cadence des requêtes.
+
+Les interrogations sont rapprochées quand un tram arrive dans quelques
+minutes et espacées quand le prochain est lointain. Les échecs sont
+retentés indéfiniment avec un délai exponentiel aléatoire, le tout sans
+dépasser un quota de requêtes par heure commun à toutes les stations.
+"""
+
+import random
+import threading
+import time
+
+FAST_DELAY = 20             # Délai minimum entre deux requêtes
+SLOW_DELAY = 10 * 60        # Délai maximum tant que des trams sont attendus
+IDLE_DELAY = 30 * 60        # Délai si plus aucun tram n'est attendu
+ARRIVAL_RATIO = 0.25        # Part du temps avant le prochain tram
+BACKOFF_BASE = 10           # Premier délai après un échec
+BACKOFF_MAX = 15 * 60       # Délai maximum après des échecs successifs
+REQUESTS_PER_HOUR = 120     # Quota de requêtes par défaut
+BURST = 5                   # Requêtes consécutives permises par le quota
+
+
+class RequestBudget:
+    """Quota de requêtes par heure (seau à jetons), partageable entre
+    plusieurs threads.
+
+    Attributs:
+        rate: jetons regagnés par seconde
+        capacity: nombre maximum de jetons
+        tokens: jetons disponibles, négatif en cas de dépassement
+    """
+
+    def __init__(self, per_hour=REQUESTS_PER_HOUR, burst=BURST):
+        if per_hour <= 0:
+            raise ValueError('Request budget must be positive, not {}.'
+                    .format(per_hour))
+        self.rate = per_hour / 3600
+        self.capacity = burst
+        self.tokens = burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def delay(self, count=1):
+        """Secondes avant que count requêtes soient permises."""
+        with self._lock:
+            self._refill()
+            return max(0, (count - self.tokens) / self.rate)
+
+    def available(self):
+        """Jetons disponibles à cet instant."""
+        with self._lock:
+            self._refill()
+            return self.tokens
+
+    def consume(self, count=1):
+        """Décompte count requêtes envoyées."""
+        with self._lock:
+            self._refill()
+            self.tokens -= count
+
+
+class PollScheduler:
+    """Calcul du délai avant la prochaine interrogation.
+
+    Attributs:
+        budget: RequestBudget, quota partagé
+        requests: nb de requêtes par interrogation
+        failures: nb d'échecs consécutifs
+    """
+
+    def __init__(self, budget, requests=1):
+        self.budget = budget
+        self.requests = requests
+        self.failures = 0
+
+    def _limit(self, delay):
+        return max(delay, self.budget.delay(self.requests))
+
+    def next_delay(self, valid_cntdown, next_arrival):
+        """Délai après une interrogation réussie.
+
+        Arguments:
+            valid_cntdown: secondes avant la fin de validité des données
+            next_arrival: secondes avant le prochain tram, None si aucun
+        """
+        self.failures = 0
+        if next_arrival is None:
+            delay = IDLE_DELAY
+        else:
+            delay = min(max(next_arrival * ARRIVAL_RATIO, FAST_DELAY),
+                    SLOW_DELAY)
+        # Inutile de redemander avant la fin de validité.
+        return self._limit(max(delay, valid_cntdown))
+
+    def retry_delay(self, retry_after=None):
+        """Délai après un échec, exponentiel avec une part aléatoire.
+
+        retry_after: délai demandé par le serveur (secondes, en-tête
+        Retry-After), respecté dans la limite de BACKOFF_MAX
+        """
+        self.failures += 1
+        delay = min(BACKOFF_BASE * 2 ** min(self.failures - 1, 16),
+                BACKOFF_MAX)
+        delay = random.uniform(delay / 2, delay)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, BACKOFF_MAX))
+        return self._limit(delay)
@@ -11,8 +11,13 @@ References:
 
 """
 
+from contextlib import contextmanager
 from time import sleep
-import smbus
+import threading
+try:
+    import smbus
+except ImportError:
+    smbus = None
 
 # i2c bus (0 -- original Pi, 1 -- Rev 2 Pi)
 DEVICE_BUS = 1
@@ -66,49 +71,294 @@ EN = 0b00000100 # Enable bit
 RW = 0b00000010 # Read/Write bit
 RS = 0b00000001 # Register select bit
 
+# DDRAM layout (2 line mode, 40 cells per line)
+DDRAM_SIZE = 0x80
+LINE_LENGTH = 0x28
+LINE_OFFSETS = (0x00, 0x40, 0x14, 0x54)
+
+# bytes needed to send a command or a character (2 nibbles, 3 bytes each)
+BYTES_PER_WRITE = 6
+
+# timings
+BYTE_DELAY = 0.0003         # pause after each byte on the per-byte path
+LONG_CMD_DELAY = 0.002      # clear display and return home take 1.52 ms
+INIT_DELAY = 0.005          # initialization commands need up to 4.1 ms
+
+# smbus block writes carry a command byte plus at most 32 data bytes
+BLOCK_SIZE = 33
+
+
+def next_ddram_addr(addr, inc=True):
+    """Address following addr in DDRAM, wrapping like the controller."""
+    if inc:
+        if addr == LINE_LENGTH - 1:
+            return 0x40
+        if addr == 0x40 + LINE_LENGTH - 1:
+            return 0x00
+        return addr + 1
+    if addr == 0x00:
+        return 0x40 + LINE_LENGTH - 1
+    if addr == 0x40:
+        return LINE_LENGTH - 1
+    return addr - 1
+
+
+def encode(value, flags=0x0, bkl=True):
+    """Bytes latching value into the lcd, as write_cmd/write_char would."""
+    light = BACKLIGHT if bkl else NOBACKLIGHT
+    high = flags | (value & 0xF0) | light
+    low = flags | ((value << 4) & 0xF0) | light
+    return bytes((high, high | EN, high & ~EN, low, low | EN, low & ~EN))
+
+
+class FairLock:
+    """Lock granted in the order it was requested (ticket lock).
+
+    threading.Lock lets the thread that just released it take it again,
+    a thread writing in a loop would starve the others.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._next = 0
+        self._serving = 0
+
+    def __enter__(self):
+        with self._cond:
+            ticket = self._next
+            self._next += 1
+            while ticket != self._serving:
+                self._cond.wait()
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self._serving += 1
+            self._cond.notify_all()
+
+
+class SharedBus:
+    """smbus object shared by every display of an I2C bus.
+
+    Each transaction holds a FairLock, so the transactions of displays
+    driven from different threads are interleaved in turn: a long
+    animation on one display delays another by one block at most.
+    The underlying bus is closed with its last user.
+
+    Attributes:
+        bus: smbus.SMBus (or compatible) object
+        port: I2C bus number, key in the shared buses
+        users: number of displays using the bus
+    """
+
+    _buses = {}
+    _buses_lock = threading.Lock()
+
+    def __init__(self, bus, port=None):
+        self.bus = bus
+        self.port = port
+        self.users = 0
+        self._lock = FairLock()
+
+    @classmethod
+    def open(cls, port):
+        """Shared bus of port, opened by its first user."""
+        with cls._buses_lock:
+            shared = cls._buses.get(port)
+            if shared is None:
+                if smbus is None:
+                    raise ImportError('smbus is required to use an I2C bus.')
+                shared = cls._buses[port] = cls(smbus.SMBus(port), port)
+            shared.users += 1
+            return shared
+
+    def write_byte(self, addr, value):
+        with self._lock:
+            self.bus.write_byte(addr, value)
+
+    def write_i2c_block_data(self, addr, cmd, values):
+        with self._lock:
+            self.bus.write_i2c_block_data(addr, cmd, values)
+
+    def close(self):
+        with self._buses_lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            if self._buses.get(self.port) is self:
+                del self._buses[self.port]
+        self.bus.close()
+
+
+class ByteTransport:
+    """Send bytes with one write_byte each, followed by a fixed pause.
+
+    Slow, but tolerant of marginal wiring and I2C modules.
+    """
+
+    def __init__(self, bus, addr):
+        self.bus = bus
+        self.addr = addr
+        self.transactions = 0
+        self.bytes_sent = 0
+
+    def transactions_for(self, count):
+        """Transactions needed to send count bytes."""
+        return count
+
+    def send(self, data):
+        for byte in data:
+            self.bus.write_byte(self.addr, byte)
+            sleep(BYTE_DELAY)
+        self.transactions += len(data)
+        self.bytes_sent += len(data)
+
+
+class BlockTransport(ByteTransport):
+    """Send bytes as smbus block writes.
+
+    The PCF8574 has no register, it latches every byte it receives
+    including the command byte, so a block of 33 bytes moves 33 pins
+    states in a single transaction. At 100 kHz each byte takes about
+    90 us on the bus, longer than the 37 us the HD44780 needs per
+    command, so no pause is required between bytes.
+    """
+
+    def transactions_for(self, count):
+        return (count + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+    def send(self, data):
+        for i in range(0, len(data), BLOCK_SIZE):
+            chunk = data[i:i + BLOCK_SIZE]
+            if len(chunk) == 1:
+                self.bus.write_byte(self.addr, chunk[0])
+            else:
+                self.bus.write_i2c_block_data(self.addr, chunk[0],
+                        list(chunk[1:]))
+            self.transactions += 1
+        self.bytes_sent += len(data)
+
+
 class LiquidCrystalI2C:
     """LCD display coupled with an I2C module.
 
     Attributes:
         addr: I2C module address
         bus: I2C/smbus object using port
+        transport: object sending the encoded bytes over bus
         bkl: state of backlight
         disp: state of display
         cusr: state of cursor
         blnk: state of blink
         curs_inc: state defining cursor behaviour
         disp_move: state defining input behaviour
+        ddram: shadow copy of DDRAM, None where the content is unknown
+        address: mirror of the controller address counter
+        in_ddram: whether the address counter points to DDRAM or CGRAM
+        shift: display shift, index of the DDRAM column shown first on
+            each line (0 to LINE_LENGTH - 1)
+        last_saved: I2C transactions saved by the last display_string call
+        saved_total: I2C transactions saved since creation
     """
 
-    def __init__(self, addr=DEVICE_ADDR, port=DEVICE_BUS):
+    def __init__(self, addr=DEVICE_ADDR, port=DEVICE_BUS, batched=True,
+            bus=None):
+        """batched: send whole commands and strings as block writes,
+        otherwise fall back to one write_byte per byte.
+        bus: object with the write_byte, write_i2c_block_data and close
+        methods of smbus.SMBus (ex: lcd_emulator.EmulatedLCD), by default
+        the SharedBus of port, common to the displays of that bus, and
+        optionally end_frame, called once each batch is sent."""
         self.addr = addr
-        self.bus = smbus.SMBus(port)
+        if bus is None:
+            bus = SharedBus.open(port)
+        self.bus = bus
+        if batched:
+            self.transport = BlockTransport(self.bus, addr)
+        else:
+            self.transport = ByteTransport(self.bus, addr)
+        self._out = bytearray()
+        self._batch_depth = 0
         self.bkl = True
         self.disp = True
         self.curs = False
         self.blnk = False
         self.curs_inc = True
         self.disp_move = False
+        self.ddram = [None] * DDRAM_SIZE
+        self.address = 0
+        self.in_ddram = True
+        self.shift = 0
+        self.last_saved = 0
+        self.saved_total = 0
 
         # Black magic initialization
+        # The first two commands reset the controller to 4 bits mode and
+        # need up to 4.1 ms, the others complete within 37 us (less than
+        # one byte on the bus) except clear display, waited for in
+        # write_cmd.
         self.write_byte(BACKLIGHT)
-        self.write_cmd(CLEARDISPLAY | RETURNHOME)
-        self.write_cmd(RETURNHOME)
-
-        self.write_cmd(FUNCTIONSET | MODE2LINE | MODE5X8DOTS | MODE4BIT)
-        self.write_cmd(DISPLAYCONTROL | DISPLAYON)
-        self.write_cmd(CLEARDISPLAY)
-        self.write_cmd(ENTRYMODESET | ENTRYINC)
-        sleep(0.2)
+        for cmd in (CLEARDISPLAY | RETURNHOME, RETURNHOME):
+            self.write_cmd(cmd)
+            sleep(INIT_DELAY)
+        with self.batch():
+            for cmd in (FUNCTIONSET | MODE2LINE | MODE5X8DOTS | MODE4BIT,
+                    DISPLAYCONTROL | DISPLAYON,
+                    CLEARDISPLAY,
+                    ENTRYMODESET | ENTRYINC):
+                self.write_cmd(cmd)
 
     def __del__(self):
         self.clear()
         self.bus.close()
 
+    @property
+    def bytes_sent(self):
+        return self.transport.bytes_sent
+
+    @contextmanager
+    def batch(self):
+        """Queue every byte written in the block and send them at once."""
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.flush()
+
+    def flush(self):
+        """Send queued bytes to i2c module.
+
+        Outside of a batch, the bus is then told the display is complete
+        if it has an end_frame method (ex: lcd_process.FramebufferLCD).
+        """
+        if self._out:
+            data = bytes(self._out)
+            self._out.clear()
+            self.transport.send(data)
+            end_frame = getattr(self.bus, 'end_frame', None)
+            if end_frame is not None and not self._batch_depth:
+                end_frame()
+
     def write_byte(self, data):
         """Write 8 bits of data to i2c module."""
-        self.bus.write_byte(self.addr, data)
-        sleep(0.0003)
+        self._out.append(data)
+        if not self._batch_depth:
+            self.flush()
+
+    def write_raw(self, data, cells=(), ddram_addr=None):
+        """Send bytes prepared with encode.
+
+        Arguments:
+            cells: (address, value) pairs written to DDRAM by data
+            ddram_addr: address counter after data, None if in CGRAM
+        """
+        with self.batch():
+            self._out += data
+        for addr, value in cells:
+            self.ddram[addr] = value
+        self.in_ddram = ddram_addr is not None
+        self.address = ddram_addr if self.in_ddram else 0
 
     def write_nibble(self, data):
         """Input 4 bits to lcd."""
@@ -123,8 +373,43 @@ class LiquidCrystalI2C:
 
     def write_cmd(self, cmd, flags=0x0):
         """Write a command to lcd."""
-        self.write_nibble(flags | (cmd & 0xF0))
-        self.write_nibble(flags | ((cmd << 4) & 0xF0))
+        with self.batch():
+            self.write_nibble(flags | (cmd & 0xF0))
+            self.write_nibble(flags | ((cmd << 4) & 0xF0))
+        self._track_cmd(cmd)
+        if cmd < ENTRYMODESET:
+            # Clear display and return home are the only slow commands.
+            self.flush()
+            sleep(LONG_CMD_DELAY)
+
+    def _track_cmd(self, cmd):
+        """Mirror the effect of a command on the address counter."""
+        if cmd & SETDDRAMADDR:
+            self.address = cmd & 0x7F
+            self.in_ddram = True
+        elif cmd & SETCGRAMADDR:
+            self.address = cmd & 0x3F
+            self.in_ddram = False
+        elif cmd & FUNCTIONSET:
+            pass
+        elif cmd & CURSORSHIFT:
+            if cmd & DISPLAYMOVE:
+                self.shift = (self.shift + (-1 if cmd & MOVERIGHT else 1)) \
+                        % LINE_LENGTH
+            elif self.in_ddram:
+                self.address = next_ddram_addr(self.address,
+                        bool(cmd & MOVERIGHT))
+        elif cmd & (DISPLAYCONTROL | ENTRYMODESET):
+            pass
+        elif cmd & RETURNHOME:
+            self.address = 0
+            self.in_ddram = True
+            self.shift = 0
+        elif cmd & CLEARDISPLAY:
+            self.ddram = [0x20] * DDRAM_SIZE
+            self.address = 0
+            self.in_ddram = True
+            self.shift = 0
 
     def write_char(self, charvalue, flags=RS):
         """Write a character to lcd.
@@ -133,24 +418,58 @@ class LiquidCrystalI2C:
         obtained either manually or by the ord built-in function.
         Custom characters are called 0 through 7.
         """
-        self.write_nibble(flags | (charvalue & 0xF0))
-        self.write_nibble(flags | ((charvalue << 4) & 0xF0))
+        with self.batch():
+            self.write_nibble(flags | (charvalue & 0xF0))
+            self.write_nibble(flags | ((charvalue << 4) & 0xF0))
+        if not flags & RS:
+            self._track_cmd(charvalue)
+        elif self.in_ddram:
+            self.ddram[self.address] = charvalue & 0xFF
+            self.address = next_ddram_addr(self.address, self.curs_inc)
+            if self.disp_move:
+                self.shift = (self.shift + (1 if self.curs_inc else -1)) \
+                        % LINE_LENGTH
+        else:
+            self.address = (self.address + (1 if self.curs_inc else -1)) & 0x3F
 
     def display_string(self, string, line=1, pos=0):
-        """Put string function with optional char positioning."""
-        if line == 1:
-            pos_new = pos
-        elif line == 2:
-            pos_new = 0x40 + pos
-        elif line == 3:
-            pos_new = 0x14 + pos
-        elif line == 4:
-            pos_new = 0x54 + pos
+        """Put string function with optional char positioning.
 
-        self.write_cmd(SETDDRAMADDR | pos_new)
-
-        for char in string:
-            self.write_char(ord(char))
+        Only the runs of cells that differ from the shadow DDRAM are sent,
+        the cursor being placed at the start of each run.
+        The whole string is sent in as few transactions as possible.
+        Returns the number of I2C transactions saved compared to a full
+        write, both counted as if sent alone.
+        """
+        before = self.bytes_sent + len(self._out)
+        addr = LINE_OFFSETS[line - 1] + pos
+
+        with self.batch():
+            if self.disp_move:
+                # Every write shifts the display, nothing can be skipped.
+                self.set_cursor_at(addr)
+                for char in string:
+                    self.write_char(ord(char))
+            else:
+                for char in string:
+                    value = ord(char) & 0xFF
+                    if self.ddram[addr] != value:
+                        if not (self.in_ddram and self.curs_inc
+                                and self.address == addr):
+                            self.set_cursor_at(addr)
+                        self.write_char(value)
+                    addr = next_ddram_addr(addr)
+
+        written = self.bytes_sent + len(self._out) - before
+        transactions = self.transport.transactions_for
+        self.last_saved = transactions(BYTES_PER_WRITE * (len(string) + 1)) \
+                - transactions(written)
+        self.saved_total += self.last_saved
+        return self.last_saved
+
+    def invalidate(self):
+        """Forget the shadow DDRAM, next display_string rewrites all cells."""
+        self.ddram = [None] * DDRAM_SIZE
 
     def set_cursor_at(self, new_pos):
         self.write_cmd(SETDDRAMADDR | new_pos)
@@ -175,6 +494,18 @@ class LiquidCrystalI2C:
     def move_display_left(self):
         self.write_cmd(CURSORSHIFT | DISPLAYMOVE | MOVELEFT)
 
+    def shift_display_to(self, shift):
+        """Shift the display until DDRAM column shift is shown first,
+        with as few shift commands as possible (one per column)."""
+        steps = (shift - self.shift) % LINE_LENGTH
+        with self.batch():
+            if steps <= LINE_LENGTH // 2:
+                for _ in range(steps):
+                    self.move_display_left()
+            else:
+                for _ in range(LINE_LENGTH - steps):
+                    self.move_display_right()
+
     def display_control(self, display=None, cursor=None, blink=None):
         """Turn on/off display options.
         Arguments:
@@ -231,12 +562,14 @@ class LiquidCrystalI2C:
 
             char printed with write_char(0)
         """
-        self.write_cmd(SETCGRAMADDR | 0x0)
-        for char in fontdata:
-            for line in char:
-                self.write_char(line)
-                
+        with self.batch():
+            self.write_cmd(SETCGRAMADDR | 0x0)
+            for char in fontdata:
+                for line in char:
+                    self.write_char(line)
+
     def load_single_custom_char(self, index, fontdata):
-        self.write_cmd(SETCGRAMADDR | (index * 8))
-        for line in fontdata:
-            self.write_char(line)
+        with self.batch():
+            self.write_cmd(SETCGRAMADDR | (index * 8))
+            for line in fontdata:
+                self.write_char(line)
@@ -1,36 +1,53 @@
 #! /usr/bin/env python3
 
-import threading
+from collections import namedtuple
+import time
 
 
-def copy_list(src, dst):
-    """Copie sans recréation."""
-    for i, val in enumerate(src):
-        try:
-            dst[i] = val
-        except IndexError:
-            dst.append(val)
+TramArriv = namedtuple('TramArriv',
+        'line_ref expected_arriv destination station journey aimed_arriv '
+        'estimated', defaults=(None, None, None, False))
+TramArriv.__doc__ = """Attributs de tram en transite.
 
+journey: référence de la course (DatedVehicleJourneyRef), si fournie
+aimed_arriv: heure d'arrivée théorique, si fournie
+estimated: heure estimée localement (arrival_model), et non annoncée
+"""
 
-class SharedList:
-    """Tableau partagé."""
 
-    def __init__(self):
-        self.list = []
-        self.lock = threading.Lock()
+Snapshot = namedtuple('Snapshot', 'version arrivals published')
+Snapshot.__doc__ = """Tableau immuable d'arrivées publié.
 
-    def __repr__(self):
-        return repr(self.list) + ' | ' + repr(self.lock)
+version: numéro incrémenté à chaque publication, 0 avant la première
+arrivals: tuple de TramArriv triés par heure d'arrivée
+published: date de publication (time.time), None avant la première
+"""
 
 
-class TramArriv:
-    """Attributs de tram en transite."""
+class SnapshotChannel:
+    """Dernières arrivées publiées pour une station.
 
-    def __init__(self, line_ref, expected_arriv, destination, station=None):
-        self.line_ref = line_ref
-        self.expected_arriv = expected_arriv
-        self.destination = destination
-        self.station = station
+    Une publication remplace l'attribut snapshot d'une seule affectation :
+    les lecteurs le lisent sans verrou ni copie, et comparent sa version
+    à la dernière traitée pour savoir s'il a changé. Un seul thread
+    publie, les lecteurs étant prévenus par ses listeners.
+
+    Attributs:
+        snapshot: Snapshot, dernière publication
+    """
+
+    def __init__(self):
+        self.snapshot = Snapshot(0, (), None)
 
     def __repr__(self):
-        pass
+        return 'SnapshotChannel({!r})'.format(self.snapshot)
+
+    def publish(self, arrivals, published=None):
+        """Remplace les arrivées publiées.
+
+        published: date de réception des arrivées (time.time), maintenant
+        par défaut
+        """
+        arrivals = tuple(sorted(arrivals, key=lambda tram: tram.expected_arriv))
+        self.snapshot = Snapshot(self.snapshot.version + 1, arrivals,
+                published or time.time())
@@ -0,0 +1,126 @@
+"""
+Conservation de la dernière réponse stop-monitoring.
+
+Les réponses de la dernière interrogation réussie sont écrites sur disque
+avec leur fin de validité. Au redémarrage (coupure de courant, cron),
+elles sont relues et publiées avant même la première requête, l'écran
+affichant aussitôt les arrivées encore à venir.
+"""
+
+from datetime import datetime
+import json
+import logging
+import os
+
+import siri_parser
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Fichier de la dernière réponse.
+
+    Le fichier est remplacé d'un seul coup : une coupure pendant
+    l'écriture laisse la version précédente intacte.
+
+    Attributs:
+        path: fichier de cache
+        restored: la réponse conservée a été publiée
+        valid_until: sa fin de validité si elle couvre toutes les stations
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.restored = False
+        self.valid_until = None
+        self._saved = None
+
+    def save(self, responses, valid_until):
+        """Enregistre les couples (références, données JSON) et leur fin
+        de validité (datetime locale ou None).
+
+        Rien n'est écrit si les données n'ont pas changé depuis le dernier
+        enregistrement (réponses 304).
+        """
+        datas = [data for _, data in responses]
+        if self._saved is not None and len(datas) == len(self._saved) \
+                and all(a is b for a, b in zip(datas, self._saved)):
+            return
+        content = json.dumps({
+            'saved': datetime.now().isoformat(),
+            'valid_until': valid_until and valid_until.isoformat(),
+            'responses': [[list(refs), data] for refs, data in responses]})
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as file:
+                file.write(content)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp, self.path)
+        except OSError:
+            logger.exception('Cannot write cache %s.', self.path,
+                    exc_info=False)
+            return
+        self._saved = datas
+
+    def load(self):
+        """Réponses enregistrées, None si aucune ou illisible.
+
+        Renvoie un tuple (date d'enregistrement, fin de validité,
+        couples (références, données JSON)).
+        """
+        try:
+            with open(self.path) as file:
+                content = json.load(file)
+            saved = datetime.fromisoformat(content['saved'])
+            valid_until = content['valid_until'] and \
+                    datetime.fromisoformat(content['valid_until'])
+            responses = [(tuple(refs), data)
+                    for refs, data in content['responses']]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.exception('Unreadable cache %s.', self.path,
+                    exc_info=False)
+            return None
+        return saved, valid_until, responses
+
+    def restore(self, shared):
+        """Publie une seule fois les arrivées encore à venir de la réponse
+        conservée.
+
+        shared: dict, SnapshotChannel par référence de station
+        Renvoie la fin de validité de la réponse si elle couvre toutes
+        les stations, None sinon.
+        """
+        if self.restored:
+            return self.valid_until
+        self.restored = True
+        cached = self.load()
+        if cached is None:
+            return None
+        saved, valid_until, responses = cached
+        try:
+            # Seules les stations encore suivies sont reprises.
+            responses = [(refs, data) for refs, data in responses
+                    if set(refs) <= shared.keys()]
+            if not responses:
+                return None
+            _, visits = siri_parser.parse_stop_monitoring(responses, shared)
+        # Seules exceptions d'une réponse mal formée, nœuds null compris.
+        except (KeyError, TypeError, ValueError):
+            logger.exception('Unreadable cache %s.', self.path,
+                    exc_info=False)
+            return None
+
+        now = datetime.now()
+        published = saved.timestamp()
+        for ref, arrivals in visits.items():
+            shared[ref].publish([arrival for arrival in arrivals
+                if arrival.expected_arriv > now], published)
+        logger.info('Arrivals loaded from cache saved at %s.',
+                '{:%H:%M:%S}'.format(saved))
+
+        if {ref for refs, _ in responses for ref in refs} >= shared.keys():
+            self.valid_until = valid_until
+        return self.valid_until
@@ -0,0 +1,102 @@
+"""
+Lecture des réponses SIRI stop-monitoring.
+
+Les réponses sont parcourues une seule fois et seuls les champs affichés
+sont extraits, les dates étant lues par datetime.fromisoformat.
+"""
+
+from datetime import datetime
+import logging
+
+import shared_data
+
+logger = logging.getLogger(__name__)
+
+
+def local_offset():
+    """Décalage UTC actuel du fuseau local."""
+    return datetime.now().astimezone().utcoffset()
+
+
+def parse_time(string, offset=None):
+    """Conversion d'une date SIRI (ISO 8601) en heure locale naïve.
+
+    offset: décalage UTC local, à fournir pour éviter de le recalculer
+    à chaque date
+    """
+    if string[-1:] == 'Z':
+        string = string[:-1] + '+00:00'
+    date = datetime.fromisoformat(string)
+    date_offset = date.utcoffset()
+    if date_offset is None:
+        return date
+    if offset is None:
+        return date.astimezone().replace(tzinfo=None)
+    return (date - date_offset + offset).replace(tzinfo=None)
+
+
+def json_object(node, name):
+    """node s'il s'agit d'un objet JSON, sinon ValueError (null ou type
+    inattendu d'une réponse mal formée)."""
+    if not isinstance(node, dict):
+        raise ValueError('{}: object expected, got {}.'.format(name,
+            type(node).__name__))
+    return node
+
+
+def visit_ref(visit, refs):
+    """Référence de la station parmi refs concernée par un passage."""
+    ref = visit.get('MonitoringRef')
+    if ref in refs:
+        return ref
+    ref = visit['MonitoredVehicleJourney']['MonitoredCall'].get('StopPointRef')
+    if ref in refs:
+        return ref
+    return refs[0] if len(refs) == 1 else None
+
+
+def parse_stop_monitoring(responses, stations):
+    """Arrivées contenues dans des réponses stop-monitoring.
+
+    Arguments:
+        responses: couples (références demandées, données JSON)
+        stations: références de toutes les stations suivies
+    Renvoie la fin de validité la plus proche (None sans livraison) et
+    un dict des TramArriv par référence de station.
+    Une réponse mal formée lève KeyError, TypeError ou ValueError.
+    """
+    valid_until = None
+    visits = {ref: [] for ref in stations}
+    TramArriv = shared_data.TramArriv
+    # Les dates d'une réponse couvrent moins de deux heures, le décalage
+    # local est calculé une seule fois.
+    offset = local_offset()
+
+    for refs, data in responses:
+        for delivery in data['ServiceDelivery']['StopMonitoringDelivery']:
+            delivery = json_object(delivery, 'StopMonitoringDelivery')
+            until = parse_time(delivery['ValidUntil'], offset)
+            if valid_until is None or until < valid_until:
+                valid_until = until
+
+            # Sans MonitoredStopVisit, plus aucun tram n'est attendu.
+            for val in delivery.get('MonitoredStopVisit', ()):
+                val = json_object(val, 'MonitoredStopVisit')
+                journey = json_object(val['MonitoredVehicleJourney'],
+                        'MonitoredVehicleJourney')
+                call = json_object(journey['MonitoredCall'], 'MonitoredCall')
+                ref = visit_ref(val, refs)
+                if ref is None:
+                    logger.warning('Visit of unknown station.')
+                    continue
+                aimed = call.get('AimedArrivalTime')
+                framed = json_object(journey.get('FramedVehicleJourneyRef',
+                    {}), 'FramedVehicleJourneyRef')
+                visits[ref].append(TramArriv(journey['LineRef'],
+                    parse_time(call['ExpectedArrivalTime'], offset),
+                    journey['DestinationShortName'],
+                    call['StopPointName'],
+                    framed.get('DatedVehicleJourneyRef'),
+                    aimed and parse_time(aimed, offset)))
+
+    return valid_until, visits
@@ -0,0 +1,202 @@
+#! /usr/bin/env python3
+"""
+Enregistrement et rejeu des réponses stop-monitoring.
+
+ResponseRecorder ajoute chaque réponse reçue par InfosThr à un fichier
+(une ligne JSON par réponse). Le serveur local rejoue ces réponses pour
+tester la récupération des données sans l'API de la CTS :
+
+    ./siri_replay.py enregistrements.jsonl --port 8080 --latency 0.2 \\
+            --errors 0.05 --throttle 0.05 --empty 0.1
+    ./main.py --url http://localhost:8080/ --station 275A token
+
+Les dates des réponses sont décalées de l'écart entre leur enregistrement
+et leur rejeu, les arrivées restant ainsi à venir.
+"""
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+
+ISO_DATE = re.compile(
+        r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?(?:Z|[+-]\d\d:\d\d)?')
+EMPTY_PERIOD = 300          # Durée (secondes) des périodes sans passage
+
+
+class ResponseRecorder:
+    """Enregistreur des réponses brutes.
+
+    Attributs:
+        path: fichier d'enregistrement
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, refs, status, body):
+        """Ajoute une réponse (corps texte) au fichier."""
+        line = json.dumps({'time': time.time(), 'refs': list(refs),
+                           'status': status, 'body': body})
+        with self._lock, open(self.path, 'a') as file:
+            file.write(line + '\n')
+
+
+def load_recordings(path):
+    """Enregistrements contenus dans un fichier."""
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def shift_dates(body, delta):
+    """Décale de delta toutes les dates ISO 8601 d'un corps de réponse."""
+    def shift(match):
+        text = match.group(0)
+        date = datetime.fromisoformat(text.replace('Z', '+00:00')) + delta
+        result = date.isoformat(timespec='seconds')
+        return result[:19] + 'Z' if text.endswith('Z') else result
+    return ISO_DATE.sub(shift, body)
+
+
+def empty_body(body):
+    """Corps de réponse sans aucun passage."""
+    data = json.loads(body)
+    for delivery in data['ServiceDelivery']['StopMonitoringDelivery']:
+        delivery.pop('MonitoredStopVisit', None)
+    return json.dumps(data)
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """Serveur rejouant des enregistrements, avec défaillances simulées.
+
+    Attributs:
+        recordings: enregistrements rejoués à tour de rôle
+        latency: délai ajouté à chaque réponse (secondes)
+        errors, throttle: probabilités d'une erreur 500 et d'un refus 429
+        empty: probabilité qu'une période de empty_period secondes soit
+            sans passage, comme une interruption de service
+        empty_period: durée de ces périodes (secondes)
+        shift: décaler les dates à l'heure du rejeu
+        quiet: ne pas journaliser chaque requête
+        counts: nb de réponses envoyées par statut
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, recordings, latency=0.0, errors=0.0,
+            throttle=0.0, empty=0.0, shift=True, quiet=False,
+            empty_period=EMPTY_PERIOD):
+        super().__init__(address, ReplayHandler)
+        self.recordings = [rec for rec in recordings if rec['status'] == 200]
+        if not self.recordings:
+            raise ValueError('No successful response to replay.')
+        self._cycle = itertools.cycle(self.recordings)
+        self.latency = latency
+        self.errors = errors
+        self.throttle = throttle
+        self.empty = empty
+        self.empty_period = empty_period
+        self._period = (None, False)
+        self.shift = shift
+        self.quiet = quiet
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def next_response(self, refs):
+        """Statut et corps de la prochaine réponse pour refs."""
+        draw = random.random()
+        if draw < self.errors:
+            return 500, '{"error": "replayed failure"}'
+        if draw < self.errors + self.throttle:
+            return 429, '{"error": "too many requests"}'
+
+        with self._lock:
+            # Priorité aux enregistrements des mêmes stations.
+            for _ in range(len(self.recordings)):
+                rec = next(self._cycle)
+                if set(rec['refs']) == set(refs):
+                    break
+        body = rec['body']
+        if self.shift:
+            body = shift_dates(body, timedelta(seconds=time.time()
+                - rec['time']))
+        if self.empty_now():
+            body = empty_body(body)
+        return 200, body
+
+    def empty_now(self):
+        """La période en cours est sans passage, tiré une fois par
+        période."""
+        period = int(time.time() // self.empty_period)
+        with self._lock:
+            if self._period[0] != period:
+                self._period = (period, random.random() < self.empty)
+            return self._period[1]
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        refs = parse_qs(urlparse(self.path).query).get('MonitoringRef', [])
+        status, body = self.server.next_response(refs)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        payload = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        if status == 429:
+            self.send_header('Retry-After', '30')
+        self.end_headers()
+        self.wfile.write(payload)
+        with self.server._lock:
+            self.server.counts[status] = self.server.counts.get(status, 0) + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Local stand-in replaying recorded CTS responses.')
+    parser.add_argument('recordings', help='file written by --record')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0,
+            help='delay added to each response (seconds)')
+    parser.add_argument('--errors', type=float, default=0.0,
+            help='probability of a 500 response')
+    parser.add_argument('--throttle', type=float, default=0.0,
+            help='probability of a 429 response')
+    parser.add_argument('--empty', type=float, default=0.0,
+            help='probability of a period without MonitoredStopVisit')
+    parser.add_argument('--empty-period', type=float, default=EMPTY_PERIOD,
+            metavar='SECONDS', help='length of these periods')
+    parser.add_argument('--no-shift', dest='shift', action='store_false',
+            help='replay dates as recorded')
+    args = parser.parse_args()
+
+    server = ReplayServer((args.host, args.port),
+            load_recordings(args.recordings), args.latency, args.errors,
+            args.throttle, args.empty, args.shift,
+            empty_period=args.empty_period)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('Responses sent:', server.counts)
+
+
+if __name__ == '__main__':
+    main()
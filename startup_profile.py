@@ -0,0 +1,83 @@
+"""
+Profil du démarrage.
+
+Mesure le temps écoulé depuis le lancement du processus jusqu'au premier
+affichage d'arrivées, étape par étape (--profile-startup). Le détail des
+imports s'obtient en lançant en plus l'interpréteur avec -X importtime :
+
+    python3 -X importtime ./main.py --profile-startup ... 2> profil.txt
+"""
+
+import os
+import sys
+import time
+
+
+def process_age():
+    """Secondes écoulées depuis le lancement du processus, None si
+    inconnu (hors Linux)."""
+    try:
+        with open('/proc/self/stat') as file:
+            stat = file.read()
+        with open('/proc/uptime') as file:
+            uptime = float(file.read().split()[0])
+        # Champ 22 (starttime), le nom du programme pouvant contenir
+        # des espaces.
+        ticks = int(stat.rpartition(')')[2].split()[19])
+        return max(0.0, uptime - ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupProfile:
+    """Instants des étapes du démarrage.
+
+    Attributs:
+        origin: lancement du processus (time.perf_counter), ou début du
+            script s'il est inconnu
+        marks: couples (étape, instant de fin)
+        stream: fichier où écrire le rapport
+    """
+
+    def __init__(self, started, stream=sys.stderr):
+        """started: time.perf_counter() relevé avant les imports."""
+        now = time.perf_counter()
+        age = process_age()
+        self.marks = []
+        self.origin = started
+        if age is not None:
+            self.origin = now - age
+            self.marks.append(('interpreter', started))
+        self.marks.append(('imports, arguments', now))
+        self.stream = stream
+        self.reported = False
+
+    def mark(self, step):
+        """Note la fin de l'étape step, écrite aussitôt si elle suit le
+        premier affichage."""
+        self.marks.append((step, time.perf_counter()))
+        if self.reported:
+            self.stream.write(self._line(-1) + '\n')
+            self.stream.flush()
+
+    def first_frame(self):
+        """Note le premier affichage d'arrivées et écrit le rapport."""
+        if self.reported:
+            return
+        self.marks.append(('first frame', time.perf_counter()))
+        self.report()
+
+    def _line(self, index):
+        step, stamp = self.marks[index]
+        index %= len(self.marks)
+        previous = self.marks[index - 1][1] if index else self.origin
+        return '{:9.1f} {:+9.1f}  {}'.format((stamp - self.origin) * 1000,
+                (stamp - previous) * 1000, step)
+
+    def report(self):
+        """Écrit la durée de chaque étape."""
+        lines = ['Startup profile (ms since launch, step duration):']
+        lines += [self._line(i) for i in range(len(self.marks))]
+        self.stream.write('\n'.join(lines) + '\n')
+        self.stream.flush()
+        self.reported = True